@@ -0,0 +1,253 @@
+import os
+import sys
+import json
+import resource
+import argparse
+import tempfile
+from time import perf_counter
+import numpy as np
+from src.db import DB
+from src.metrics import metrics
+from src.replay import DURATION_ENGINES, Replay, get_replay_fingerprint
+from src.evaluation import Season
+from src.workers import ReplayFile
+from src.synthetic import write_replays
+
+STAGES = ('fingerprint', 'open', 'decode', 'duration', 'metrics', 'db_write',
+          'scoring')
+PERCENTILES = (50, 90, 99)
+
+# a stage is flagged when it got this much slower than the baseline
+REGRESSION_THRESHOLD = 1.1
+
+# sub-stages of the Replay constructor counted as opening the replay
+OPEN_STAGES = ('mpq_open', 'protocol_build')
+
+
+def get_peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == 'darwin':
+        return peak_rss
+
+    return peak_rss * 1024
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.timings = {stage: [] for stage in STAGES}
+
+    def add(self, stage, secs):
+        self.timings[stage].append(secs)
+
+    def time(self, stage, func, *args, **kwargs):
+        start = perf_counter()
+        result = func(*args, **kwargs)
+        self.add(stage, perf_counter() - start)
+
+        return result
+
+    def get_report(self):
+        stages = {}
+
+        for stage in STAGES:
+            timings = np.array(self.timings[stage])
+
+            if len(timings) == 0:
+                continue
+
+            stages[stage] = {
+                'count': len(timings),
+                'total_secs': float(timings.sum()),
+                'per_sec': float(len(timings) / timings.sum())
+                if timings.sum() > 0 else float('inf'),
+                'max_ms': float(timings.max() * 1000)
+            }
+
+            for p in PERCENTILES:
+                stages[stage][f'p{p}_ms'] = float(
+                    np.percentile(timings, p) * 1000)
+
+        # ru_maxrss is the peak of the whole process, not of a single stage
+        return {'stages': stages, 'peak_rss_mb': get_peak_rss() / 1024**2}
+
+
+def get_replay_paths(replay_dir):
+    return sorted(
+        os.path.join(replay_dir, file_name)
+        for file_name in os.listdir(replay_dir)
+        if file_name.endswith('.StormReplay'))
+
+
+def run_benchmark(replay_paths,
+                  db_path,
+                  league,
+                  season,
+                  duration_engine='single_pass',
+                  scoring_engine='vectorized'):
+    timer = StageTimer()
+    db = DB(path=db_path)
+    db.create_db()
+
+    # the constructor is split into open, decode and duration with the
+    # instrumented sub-stages of its replay record
+    metrics_enabled = metrics.enabled
+    metrics.enable()
+
+    for replay_path in replay_paths:
+        replay_file = ReplayFile(file_name=os.path.basename(replay_path))
+
+        fingerprint = timer.time('fingerprint', get_replay_fingerprint,
+                                 replay_path)
+
+        metrics.begin_replay(replay_path)
+        try:
+            replay = timer.time('decode',
+                                Replay,
+                                replay_path=replay_path,
+                                league=league,
+                                season=season,
+                                match_id=replay_file.match_id,
+                                round_id=replay_file.round_id,
+                                duration_engine=duration_engine,
+                                fingerprint=fingerprint)
+        except Exception as e:
+            metrics.end_replay(error=e)
+            raise
+        stages = metrics.end_replay()['stages']
+
+        open_secs = sum(stages[stage]['secs'] for stage in OPEN_STAGES
+                        if stage in stages)
+        duration_secs = stages['duration']['secs']
+        timer.timings['decode'][-1] -= open_secs + duration_secs
+        timer.add('open', open_secs)
+        timer.add('duration', duration_secs)
+
+        def get_metrics():
+            replay.get_metrics()
+            replay.get_player_info()
+
+        timer.time('metrics', get_metrics)
+
+        timer.time('db_write', db.add_replay, replay.get_slim_summary())
+
+    def score_season():
+        season_entity = Season(league=league,
+                               season_id=season,
+                               db=db,
+                               scoring_engine=scoring_engine)
+        db.add_season_scores(season_entity, update=True)
+
+    timer.time('scoring', score_season)
+
+    db.session.close()
+
+    if not metrics_enabled:
+        metrics.disable()
+
+    return timer.get_report()
+
+
+def compare_reports(report, baseline):
+    # ratio > 1 means slower than the baseline, baselines saved before the
+    # process peak RSS was split out hold the stages only
+    comparison = {}
+    baseline = baseline.get('stages', baseline)
+
+    for stage, stats in report['stages'].items():
+        if stage not in baseline:
+            continue
+
+        base_stats = baseline[stage]
+        comparison[stage] = {
+            key: stats[key] / base_stats[key]
+            for key in ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms')
+            if base_stats.get(key, 0) > 0
+        }
+
+    return comparison
+
+
+def print_report(report, comparison=None):
+    columns = ('count', 'per_sec', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms')
+
+    print(f'{"stage":<12}' + ''.join(f'{column:>13}' for column in columns))
+
+    for stage, stats in report['stages'].items():
+        line = f'{stage:<12}' + ''.join(f'{stats[column]:>13.2f}'
+                                        for column in columns)
+
+        if comparison is not None and stage in comparison:
+            ratio = comparison[stage].get('p50_ms')
+
+            if ratio is not None:
+                line += f'  p50 x{ratio:.2f}'
+                if ratio > REGRESSION_THRESHOLD:
+                    line += ' REGRESSION'
+
+        print(line)
+
+    print(f'process peak RSS: {report["peak_rss_mb"]:.2f} MB')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark replay ingestion and scoring.')
+    parser.add_argument('--replay-dir',
+                        help='directory of real replays, synthetic replays '
+                        'are generated otherwise')
+    parser.add_argument('--n-replays', type=int, default=9)
+    parser.add_argument('--n-events', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--league', default='Synthetic')
+    parser.add_argument('--season', type=int, default=1)
+    parser.add_argument('--duration-engine',
+                        choices=DURATION_ENGINES,
+                        default='single_pass')
+    parser.add_argument('--save', help='save the report as baseline json')
+    parser.add_argument('--compare', help='baseline json to compare against')
+    parser.add_argument('--metrics',
+                        help='write the instrumented sub-stage metrics as '
+                        'prometheus text')
+    args = parser.parse_args(args)
+
+    if args.metrics is not None:
+        metrics.enable()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.replay_dir is not None:
+            replay_paths = get_replay_paths(args.replay_dir)
+        else:
+            replay_dir = os.path.join(work_dir, 'replays')
+            replay_paths = write_replays(directory=replay_dir,
+                                         n_replays=args.n_replays,
+                                         league=args.league,
+                                         season=args.season,
+                                         n_events=args.n_events,
+                                         seed=args.seed)
+
+        report = run_benchmark(replay_paths=replay_paths,
+                               db_path=os.path.join(work_dir, 'benchmark.db'),
+                               league=args.league,
+                               season=args.season,
+                               duration_engine=args.duration_engine)
+
+    comparison = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            comparison = compare_reports(report, json.load(f))
+
+    print_report(report, comparison)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.metrics is not None:
+        with open(args.metrics, 'w') as f:
+            f.write(metrics.to_prometheus())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import os
+import zlib
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from src.protocols import get_latest_build
+
+CACHE_VERSION = 2
+CACHE_FILE_EXTENSION = '.replay.cache'
+
+
+class ReplayCache(object):
+    def __init__(self, cache_dir, max_size=512 * 1024**2):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+
+        os.makedirs(self._cache_dir, exist_ok=True)
+
+        # entries decoded with another heroprotocol release are never hit
+        self._protocol_build = f'protocol{get_latest_build():05d}'
+
+        # key -> size, least recently used first. Parser threads share
+        # one cache, the lock guards the index, not the file reads.
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.__load_index__()
+        self.__evict__()
+
+    def __load_index__(self):
+        entries = []
+
+        with os.scandir(self._cache_dir) as dir_entries:
+            for entry in dir_entries:
+                if not entry.name.endswith(CACHE_FILE_EXTENSION):
+                    continue
+
+                stat = entry.stat()
+                key = entry.name[:-len(CACHE_FILE_EXTENSION)]
+                entries.append((stat.st_mtime, key, stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+
+    def __get_path__(self, key):
+        return os.path.join(self._cache_dir, key + CACHE_FILE_EXTENSION)
+
+    def get_key(self, replay_bytes):
+        return self.get_digest_key(hashlib.sha256(replay_bytes).hexdigest())
+
+    def get_digest_key(self, digest):
+        # digest: sha256 hex digest of the replay bytes, e.g. the replay
+        # fingerprint
+        return f'{digest}-{self._protocol_build}-v{CACHE_VERSION}'
+
+    def get(self, key):
+        path = self.__get_path__(key)
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.__drop__(key)
+            return None
+
+        # a truncated or otherwise corrupt entry is a miss
+        try:
+            summary = pickle.loads(zlib.decompress(data))
+        except Exception:
+            with self._lock:
+                self.__remove__(key)
+            return None
+
+        with self._lock:
+            # mark as recently used, also for other processes sharing the
+            # dir
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # evicted by another thread meanwhile
+                return summary
+
+            if key not in self._entries:
+                self._size += len(data)
+                self._entries[key] = len(data)
+            self._entries.move_to_end(key)
+
+        return summary
+
+    def put(self, key, summary):
+        data = zlib.compress(
+            pickle.dumps(summary, protocol=pickle.HIGHEST_PROTOCOL))
+
+        if len(data) > self._max_size:
+            return
+
+        path = self.__get_path__(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+
+        with self._lock:
+            os.replace(tmp_path, path)
+
+            self.__drop__(key)
+            self._entries[key] = len(data)
+            self._size += len(data)
+
+            self.__evict__()
+
+    def __drop__(self, key):
+        if key in self._entries:
+            self._size -= self._entries.pop(key)
+
+    def __remove__(self, key):
+        self.__drop__(key)
+
+        try:
+            os.remove(self.__get_path__(key))
+        except FileNotFoundError:
+            pass
+
+    def __evict__(self):
+        while self._size > self._max_size and len(self._entries) > 0:
+            key = next(iter(self._entries))
+            self.__remove__(key)
+
+    def get_size(self):
+        return self._size
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries.keys()):
+                self.__remove__(key)
@@ -1,12 +1,27 @@
-from sqlalchemy import create_engine
-from sqlalchemy import Column, ForeignKey, Boolean, Integer, Float, String, Date, Time
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy import create_engine, event, func, insert, or_, select, text
+from sqlalchemy import update
+from sqlalchemy import and_, cast, inspect
+from sqlalchemy import Column, ForeignKey, Index, Boolean, Integer, Float, String, Date, Time
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import scoped_session, sessionmaker, relationship
 from sqlalchemy.ext.declarative import declarative_base
+import math
+import argparse
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from dateutil import tz
+from src.metrics import metrics
 
 Base = declarative_base()
 
+SCORE_COLUMNS = ('kills', 'deaths', 'assists', 'exp_per_min', 'healing',
+                 'damage_soaked', 'winner', 'under_10_mins', 'under_15_mins',
+                 'total')
+STAT_COLUMNS = ('kills', 'deaths', 'assists', 'exp_contrib', 'healing',
+                'damage_soaked')
+
 
 class Player(Base):
     __tablename__ = 'Player'
@@ -43,6 +58,9 @@ class Round(Base):
     duration = Column(Integer)
     time = Column(Time)
 
+    # sha256 of the replay file, None for rounds stored before
+    fingerprint = Column(String)
+
     match = relationship("Match", back_populates="rounds")
     stats = relationship("PlayerStats", back_populates="round")
 
@@ -65,6 +83,21 @@ class PlayerStats(Base):
     round = relationship("Round", back_populates="stats")
 
 
+class PlayerStatsTimeline(Base):
+    __tablename__ = 'PlayerStatisticsTimeline'
+
+    id = Column(Integer, primary_key=True)
+    round_id = Column(Integer, ForeignKey('Round.id'))
+    player_id = Column(Integer, ForeignKey('Player.id'))
+    gameloop = Column(Integer)
+    kills = Column(Float)
+    deaths = Column(Float)
+    assists = Column(Float)
+    exp_contrib = Column(Float)
+    healing = Column(Float)
+    damage_soaked = Column(Float)
+
+
 class PlayerScores(Base):
     __tablename__ = 'PlayerScores'
 
@@ -86,220 +119,1062 @@ class PlayerScores(Base):
     match = relationship("Match", back_populates="scores")
 
 
+# Materialized per player and season, kept up to date by DB.add_replays
+# and DB.add_player_scores. Durations are in minutes.
+class PlayerSeasonStats(Base):
+    __tablename__ = 'PlayerSeasonStatistics'
+
+    id = Column(Integer, primary_key=True)
+    player_id = Column(Integer, ForeignKey('Player.id'))
+    league = Column(String)
+    season = Column(Integer)
+    rounds_played = Column(Integer)
+    wins = Column(Integer)
+    minutes_played = Column(Float)
+    kills = Column(Float)
+    deaths = Column(Float)
+    assists = Column(Float)
+    exp_contrib = Column(Float)
+    healing = Column(Float)
+    damage_soaked = Column(Float)
+
+
+class PlayerSeasonScores(Base):
+    __tablename__ = 'PlayerSeasonScores'
+
+    id = Column(Integer, primary_key=True)
+    player_id = Column(Integer, ForeignKey('Player.id'))
+    league = Column(String)
+    season = Column(Integer)
+    matches_scored = Column(Integer)
+    kills = Column(Float)
+    deaths = Column(Float)
+    assists = Column(Float)
+    exp_per_min = Column(Float)
+    healing = Column(Float)
+    damage_soaked = Column(Float)
+    winner = Column(Float)
+    under_10_mins = Column(Float)
+    under_15_mins = Column(Float)
+    total = Column(Float)
+
+
+class Generation(Base):
+    # counters bumped in the transaction of every write to the tables they
+    # cover, shared by all DB instances and processes using the database
+    __tablename__ = 'Generation'
+
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False)
+
+
+# Natural keys. NULL never conflicts in a unique index, so the nullable
+# parts of the match and round keys are indexed through coalesce.
+Index('ux_player_blizzard_id', Player.blizzard_id, unique=True)
+Index('ux_match_key',
+      func.coalesce(Match.league, ''),
+      func.coalesce(Match.season, -1),
+      func.coalesce(Match.match_in_season, -1),
+      unique=True)
+Index('ux_round_key',
+      Round.match_id,
+      func.coalesce(Round.round_in_match, -1),
+      Round.map_name,
+      Round.duration,
+      Round.time,
+      unique=True)
+Index('ux_round_fingerprint', Round.fingerprint, unique=True)
+Index('ux_player_stats_key',
+      PlayerStats.round_id,
+      PlayerStats.player_id,
+      PlayerStats.winner_team,
+      PlayerStats.kills,
+      PlayerStats.deaths,
+      PlayerStats.assists,
+      PlayerStats.exp_contrib,
+      PlayerStats.healing,
+      PlayerStats.damage_soaked,
+      unique=True)
+Index('ix_player_stats_player_id', PlayerStats.player_id)
+Index('ux_player_stats_timeline_key',
+      PlayerStatsTimeline.round_id,
+      PlayerStatsTimeline.player_id,
+      PlayerStatsTimeline.gameloop,
+      unique=True)
+Index('ux_player_scores_key',
+      PlayerScores.match_id,
+      PlayerScores.player_id,
+      unique=True)
+Index('ux_player_season_stats_key',
+      func.coalesce(PlayerSeasonStats.league, ''),
+      func.coalesce(PlayerSeasonStats.season, -1),
+      PlayerSeasonStats.player_id,
+      unique=True)
+Index('ux_player_season_scores_key',
+      func.coalesce(PlayerSeasonScores.league, ''),
+      func.coalesce(PlayerSeasonScores.season, -1),
+      PlayerSeasonScores.player_id,
+      unique=True)
+Index('ix_player_season_stats_season', PlayerSeasonStats.league,
+      PlayerSeasonStats.season)
+Index('ix_player_season_scores_season', PlayerSeasonScores.league,
+      PlayerSeasonScores.season)
+
+
 class DataBaseException(Exception):
     pass
 
 
-class DB(object):
-    def __init__(self, path, framework='sqlite'):
-        self.engine = create_engine(f'{framework}:///{path}')
+def _set_wal_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
 
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+    # WAL is stored in the file, NORMAL only syncs at checkpoints, which is
+    # safe with WAL: a power loss can only lose the last commits
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
 
-    def create_db(self):
-        Base.metadata.create_all(self.engine)
 
-    def __get_entry__(self, query, entry, entry_class):
-        query_result = self.session.query(entry_class).filter(*query).all()
+def _set_read_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only=ON')
+    cursor.close()
 
-        if len(query_result) == 0:
-            return entry, False
 
-        elif len(query_result) == 1:
-            return query_result[0], True
+class LookupCache(object):
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries = OrderedDict()
 
-        else:
-            raise DataBaseException(
-                'Ambigious entry. Please contact the developer.')
+    def __contains__(self, key):
+        return key in self._entries
 
-    def __get_player__(self, name, blizzard_id):
-        query = (Player.blizzard_id == blizzard_id, )
-        player = Player(name=name, blizzard_id=blizzard_id)
+    def __len__(self):
+        return len(self._entries)
 
-        player, exists = self.__get_entry__(query=query,
-                                            entry=player,
-                                            entry_class=Player)
+    def get(self, key, default=None):
+        if key not in self._entries:
+            return default
 
-        if not exists:
-            self.session.add(player)
-            self.session.commit()
+        self._entries.move_to_end(key)
 
-        return player
+        return self._entries[key]
 
-    def __get_player_by_id__(self, id):
-        query_result = self.session.query(Player).filter(Player.id == id).all()
+    def set(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
 
-        return query_result[0]
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
 
-    def __get_match__(self, league, season, match_in_season, date):
-        query = (Match.league == league, Match.season == season,
-                 Match.match_in_season == match_in_season)
-        match = Match(league=league,
-                      season=season,
-                      match_in_season=match_in_season,
-                      date=date)
+    def clear(self):
+        self._entries.clear()
 
-        match, exists = self.__get_entry__(query=query,
-                                           entry=match,
-                                           entry_class=Match)
 
-        if not exists:
-            self.session.add(match)
-            self.session.commit()
+class ResultCache(object):
+    # LRU bounded by the summed size of the cached values in bytes
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._n_bytes = 0
 
-        return match
+        # shared by the reading threads of a concurrent DB
+        self._lock = threading.Lock()
 
-    def __get_match_by_id__(self, id):
-        query_result = self.session.query(Match).filter(Match.id == id).all()
+    def __contains__(self, key):
+        return key in self._entries
 
-        return query_result[0]
+    def __len__(self):
+        return len(self._entries)
 
-    def __get_round__(self, match, round_in_match, map_name, duration, time):
-        query = (Round.match_id == match.id,
-                 Round.round_in_match == round_in_match,
-                 Round.map_name == map_name, Round.duration == duration,
-                 Round.time == time)
-        round = Round(round_in_match=round_in_match,
-                      map_name=map_name,
-                      duration=duration,
-                      time=time)
+    @property
+    def n_bytes(self):
+        return self._n_bytes
 
-        round, exists = self.__get_entry__(query=query,
-                                           entry=round,
-                                           entry_class=Round)
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
 
-        if not exists:
-            match.rounds.append(round)
+            self._entries.move_to_end(key)
 
-            self.session.add(round)
-            self.session.commit()
+            return self._entries[key][0]
 
-        return round
-
-    def __get_player_stat__(self, round, player, winner_team, kills, deaths,
-                            assists, exp_contrib, healing, damage_soaked):
-
-        query = (PlayerStats.round_id == round.id,
-                 PlayerStats.player_id == player.id,
-                 PlayerStats.winner_team == winner_team,
-                 PlayerStats.kills == kills, PlayerStats.deaths == deaths,
-                 PlayerStats.assists == assists,
-                 PlayerStats.exp_contrib == exp_contrib,
-                 PlayerStats.healing == healing,
-                 PlayerStats.damage_soaked == damage_soaked)
-
-        player_stats = PlayerStats(winner_team=winner_team,
-                                   kills=kills,
-                                   deaths=deaths,
-                                   assists=assists,
-                                   exp_contrib=exp_contrib,
-                                   healing=healing,
-                                   damage_soaked=damage_soaked)
-
-        player_stats, exists = self.__get_entry__(query=query,
-                                                  entry=player_stats,
-                                                  entry_class=PlayerStats)
-
-        if not exists:
-            player.stats.append(player_stats)
-            round.stats.append(player_stats)
-
-            self.session.add(player_stats)
-            self.session.commit()
+    def set(self, key, value, n_bytes):
+        # values larger than the whole cache are not kept
+        if n_bytes > self._max_bytes:
+            return
 
-        return player_stats
+        with self._lock:
+            if key in self._entries:
+                self._n_bytes -= self._entries.pop(key)[1]
 
-    def __get_player_scores__(self, player, match, kills, deaths, assists,
-                              exp_per_min, healing, damage_soaked, winner,
-                              under_10_mins, under_15_mins, total):
+            self._entries[key] = (value, n_bytes)
+            self._n_bytes += n_bytes
 
-        query = (PlayerScores.player_id == player.id,
-                 PlayerScores.match_id == match.id)
+            while self._n_bytes > self._max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._n_bytes -= evicted_bytes
 
-        player_scores = PlayerScores(kills=kills,
-                                     deaths=deaths,
-                                     assists=assists,
-                                     exp_per_min=exp_per_min,
-                                     healing=healing,
-                                     damage_soaked=damage_soaked,
-                                     winner=winner,
-                                     under_10_mins=under_10_mins,
-                                     under_15_mins=under_15_mins,
-                                     total=total)
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._n_bytes = 0
 
-        player_scores, exists = self.__get_entry__(query=query,
-                                                   entry=player_scores,
-                                                   entry_class=PlayerScores)
 
-        if not exists:
-            player.scores.append(player_scores)
-            match.scores.append(player_scores)
+class DB(object):
+    def __init__(self,
+                 path,
+                 framework='sqlite',
+                 cache_size=4096,
+                 result_cache_bytes=64 * 1024**2,
+                 concurrent=False,
+                 busy_timeout=30.0):
+        # concurrent: one session per thread, a separate read-only engine
+        # for evaluation and, on SQLite, WAL so readers don't block on
+        # commits and vice versa
+        self._concurrent = concurrent
+
+        if framework == 'sqlite':
+            # seconds a connection waits for a lock before raising
+            # "database is locked"
+            self.engine = create_engine(
+                f'{framework}:///{path}',
+                connect_args={'timeout': busy_timeout})
+        else:
+            self.engine = create_engine(f'{framework}:///{path}')
 
-            self.session.add(player_scores)
-            self.session.commit()
+        # Player and Match rows are never updated, so loaded instances stay
+        # valid across commits
+        Session = sessionmaker(bind=self.engine, expire_on_commit=False)
 
-        return player_scores
+        if not concurrent:
+            self.session = Session()
+            self.read_engine = self.engine
+            self.read_session = self.session
+        else:
+            if framework == 'sqlite':
+                event.listen(self.engine, 'connect', _set_wal_pragmas)
+
+                # autocommit, every read sees the latest commit instead of
+                # the snapshot of a long-lived read transaction
+                self.read_engine = create_engine(
+                    f'sqlite:///file:{path}?mode=ro&uri=true',
+                    connect_args={'timeout': busy_timeout},
+                    isolation_level='AUTOCOMMIT')
+                event.listen(self.read_engine, 'connect', _set_read_pragmas)
+            else:
+                self.read_engine = self.engine
+
+            self.session = scoped_session(Session)
+            self.read_session = scoped_session(
+                sessionmaker(bind=self.read_engine, expire_on_commit=False))
+
+        # blizzard_id / (league, season, match_in_season) -> primary key
+        self._player_ids = LookupCache(max_size=cache_size)
+        self._match_ids = LookupCache(max_size=cache_size)
+
+        # None until checked, see __can_upsert__
+        self._upsert = None
+
+        # results are keyed by the generation of the stats tables, the
+        # cache is cleared once a newer one is seen, see get_generation
+        self._generation = None
+        self.result_cache = ResultCache(max_bytes=result_cache_bytes)
+
+        # rows inserted in a rolled back transaction must not be served
+        event.listen(self.session, 'after_soft_rollback',
+                     lambda session, previous_transaction: self.clear_cache())
+
+        # executemany calls count as one statement
+        event.listen(self.engine, 'before_cursor_execute',
+                     lambda *args: metrics.count('db_statements'))
+        event.listen(self.session, 'after_commit',
+                     lambda session: metrics.count('db_commits'))
+
+    def close_sessions(self):
+        # releases the sessions of the calling thread, e.g. when a worker
+        # thread finishes
+        if self._concurrent:
+            self.session.remove()
+            self.read_session.remove()
+
+    def clear_cache(self):
+        self._player_ids.clear()
+        self._match_ids.clear()
+
+    def get_generation(self):
+        # generation of the matches, rounds and player stats, read from the
+        # database on every call so writes of other DB instances and
+        # processes are seen. None for databases without the Generation
+        # table, see migrate.
+        try:
+            with self.read_engine.connect() as connection:
+                generation = connection.execute(
+                    select(Generation.value).filter(
+                        Generation.name == 'stats')).scalar()
+        except OperationalError:
+            generation = None
+
+        if generation != self._generation:
+            self._generation = generation
+            self.result_cache.clear()
+
+        return generation
+
+    def __bump_generation__(self):
+        # part of the write transaction, committed or rolled back with it
+        self.session.execute(
+            update(Generation).filter(Generation.name == 'stats').values(
+                value=Generation.value + 1))
+
+    def __add_generations__(self):
+        with self.engine.begin() as connection:
+            if connection.execute(
+                    select(Generation.name).filter(
+                        Generation.name == 'stats')).first() is None:
+                connection.execute(insert(Generation), [{
+                    'name': 'stats',
+                    'value': 0
+                }])
 
-    def add_replay(self, replay):
+    def create_db(self):
+        Base.metadata.create_all(self.engine)
+        self.__add_generations__()
+        self._upsert = None
+
+    def migrate(self):
+        # adds the tables and indexes missing in databases of older versions
+        existing_tables = set(inspect(self.engine).get_table_names())
+        Base.metadata.create_all(self.engine)
+        self.__add_missing_columns__(existing_tables)
+        existing_indexes = self.__get_index_names__()
+
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+
+                try:
+                    index.create(bind=self.engine)
+                except IntegrityError as e:
+                    raise DataBaseException(
+                        f'Could not create {index.name}. Please remove the duplicate entries in {table.name} first.'
+                    ) from e
+
+        self.__add_generations__()
+        self._upsert = None
+
+        # aggregates of the rows stored before the tables existed
+        if not {
+                PlayerSeasonStats.__tablename__,
+                PlayerSeasonScores.__tablename__
+        } <= existing_tables:
+            self.rebuild_season_aggregates()
+
+    def __add_missing_columns__(self, table_names):
+        # create_all skips existing tables, columns added since are nullable
+        inspector = inspect(self.engine)
+
+        for table in Base.metadata.sorted_tables:
+            if table.name not in table_names:
+                continue
+
+            existing_columns = {
+                column['name']
+                for column in inspector.get_columns(table.name)
+            }
+
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                column_type = column.type.compile(dialect=self.engine.dialect)
+                with self.engine.begin() as connection:
+                    connection.execute(
+                        text(f'ALTER TABLE "{table.name}" ADD COLUMN '
+                             f'"{column.name}" {column_type}'))
+
+    def __get_index_names__(self):
+        # reflection skips expression indexes, so ask sqlite_master
+        if self.engine.dialect.name != 'sqlite':
+            return {
+                index['name']
+                for table_name in inspect(self.engine).get_table_names()
+                for index in inspect(self.engine).get_indexes(table_name)
+            }
+
+        with self.engine.connect() as connection:
+            result = connection.execute(
+                text("SELECT name FROM sqlite_master "
+                     "WHERE type = 'index'")).all()
+
+        return {row[0] for row in result}
+
+    def __can_upsert__(self):
+        # ON CONFLICT only deduplicates once the unique indexes exist
+        if self._upsert is None:
+            if self.engine.dialect.name != 'sqlite':
+                self._upsert = False
+            else:
+                existing = self.__get_index_names__()
+
+                self._upsert = all(
+                    index.name in existing
+                    for table in Base.metadata.sorted_tables
+                    for index in table.indexes if index.unique)
+
+        return self._upsert
+
+    def __insert_unknown__(self, model, get_unknown_rows, query):
+        # get_unknown_rows returns the rows query has not found yet
+        if self.__can_upsert__():
+            rows = get_unknown_rows()
+            if len(rows) > 0:
+                self.session.execute(
+                    sqlite_insert(model).on_conflict_do_nothing(), rows)
+                query()
+
+            return
+
+        query()
+
+        rows = get_unknown_rows()
+        if len(rows) > 0:
+            self.session.execute(insert(model), rows)
+            query()
+
+    @staticmethod
+    def __get_replay_rows__(replay):
         # set time
         dt = datetime.fromtimestamp(replay.utc_time, tz.tzutc())
         dt = dt.astimezone(tz.gettz('America/New_York'))
 
-        # add replay data to DB
-        match = self.__get_match__(league=replay.league,
-                                   season=replay.season,
-                                   match_in_season=replay.match_id,
-                                   date=dt.date())
-
-        round = self.__get_round__(match=match,
-                                   round_in_match=replay.round_id,
-                                   map_name=replay.map_name,
-                                   duration=replay.get_duration_mins(),
-                                   time=dt.time())
-
         metrics_df = replay.get_metrics()
         player_info_df = replay.get_player_info()
 
         df = player_info_df.merge(metrics_df, on='player_name')
 
-        for i in range(len(df)):
-            series = df.iloc[i]
+        match_key = (replay.league, replay.season, replay.match_id)
+        round_key = (replay.round_id, replay.map_name,
+                     replay.get_duration_mins(), dt.time())
+
+        player_rows = [{
+            'name': row['player_name'],
+            'blizzard_id': int(row['blizzard_id']),
+            'winner_team': bool(row['winner_team']),
+            'kills': float(row['kills']),
+            'deaths': float(row['deaths']),
+            'assists': float(row['assists']),
+            'exp_contrib': float(row['exp_contrib']),
+            'healing': float(row['healing']),
+            'damage_soaked': float(row['damage_soaked'])
+        } for row in df.to_dict(orient='records')]
+
+        return match_key, dt.date(), round_key, player_rows, \
+            replay.get_metrics_timeline()
+
+    @staticmethod
+    def __in__(column, values):
+        # set-based counterpart of column == value, None matches NULL
+        values = set(values)
+
+        if None in values:
+            values.discard(None)
+            return or_(column.in_(values), column.is_(None))
+
+        return column.in_(values)
+
+    @staticmethod
+    def __check_unique__(keys):
+        if len(keys) != len(set(keys)):
+            raise DataBaseException(
+                'Ambigious entry. Please contact the developer.')
+
+    def __bulk_get_players__(self, players):
+        # players: blizzard_id -> name of the first occurence
+        player_ids = {
+            blizzard_id: self._player_ids.get(blizzard_id)
+            for blizzard_id in players if blizzard_id in self._player_ids
+        }
+
+        def query_players():
+            result = self.session.query(Player.id, Player.blizzard_id).filter(
+                Player.blizzard_id.in_([
+                    blizzard_id for blizzard_id in players
+                    if blizzard_id not in player_ids
+                ])).all()
+            self.__check_unique__([row.blizzard_id for row in result])
+
+            for row in result:
+                player_ids[row.blizzard_id] = row.id
+                self._player_ids.set(row.blizzard_id, row.id)
+
+        def get_unknown_players():
+            return [{
+                'name': name,
+                'blizzard_id': blizzard_id
+            } for blizzard_id, name in players.items()
+                    if blizzard_id not in player_ids]
+
+        self.__insert_unknown__(model=Player,
+                                get_unknown_rows=get_unknown_players,
+                                query=query_players)
+
+        return player_ids
+
+    def __bulk_get_matches__(self, matches):
+        # matches: (league, season, match_in_season) -> date
+        match_ids = {
+            key: self._match_ids.get(key)
+            for key in matches if key in self._match_ids
+        }
+
+        def query_matches():
+            keys = {key for key in matches if key not in match_ids}
+            result = self.session.query(
+                Match.id, Match.league, Match.season,
+                Match.match_in_season).filter(
+                    self.__in__(Match.league, [key[0] for key in keys]),
+                    self.__in__(Match.season, [key[1] for key in keys]),
+                    self.__in__(Match.match_in_season,
+                                [key[2] for key in keys])).all()
+
+            for row in result:
+                key = (row.league, row.season, row.match_in_season)
+                if key not in keys:
+                    continue
+                if key in match_ids:
+                    raise DataBaseException(
+                        'Ambigious entry. Please contact the developer.')
+
+                match_ids[key] = row.id
+                self._match_ids.set(key, row.id)
+
+        def get_unknown_matches():
+            return [{
+                'league': key[0],
+                'season': key[1],
+                'match_in_season': key[2],
+                'date': date
+            } for key, date in matches.items() if key not in match_ids]
+
+        self.__insert_unknown__(model=Match,
+                                get_unknown_rows=get_unknown_matches,
+                                query=query_matches)
+
+        return match_ids
+
+    def __bulk_get_rounds__(self, rounds):
+        # rounds: (match_id, round_in_match, map_name, duration, time) ->
+        # fingerprint
+        round_ids = {}
+
+        # id -> fingerprint of rounds stored without one
+        missing_fingerprints = {}
+
+        def query_rounds():
+            keys = {key for key in rounds if key not in round_ids}
+            result = self.session.query(
+                Round.id, Round.match_id, Round.round_in_match,
+                Round.map_name, Round.duration, Round.time,
+                Round.fingerprint).filter(
+                    Round.match_id.in_({key[0] for key in keys})).all()
+
+            for row in result:
+                key = (row.match_id, row.round_in_match, row.map_name,
+                       row.duration, row.time)
+                if key not in keys:
+                    continue
+                if key in round_ids:
+                    raise DataBaseException(
+                        'Ambigious entry. Please contact the developer.')
+                round_ids[key] = row.id
+
+                if row.fingerprint is None and rounds[key] is not None:
+                    missing_fingerprints[row.id] = rounds[key]
+
+        def get_unknown_rounds():
+            return [{
+                'match_id': key[0],
+                'round_in_match': key[1],
+                'map_name': key[2],
+                'duration': key[3],
+                'time': key[4],
+                'fingerprint': fingerprint
+            } for key, fingerprint in rounds.items() if key not in round_ids]
+
+        self.__insert_unknown__(model=Round,
+                                get_unknown_rows=get_unknown_rounds,
+                                query=query_rounds)
+
+        if len(missing_fingerprints) > 0:
+            self.session.bulk_update_mappings(
+                Round, [{
+                    'id': round_id,
+                    'fingerprint': fingerprint
+                } for round_id, fingerprint in missing_fingerprints.items()])
+
+        return round_ids
+
+    def get_known_fingerprints(self, fingerprints):
+        # the fingerprints of replays already stored, checked in one query
+        # empty fingerprints identify nothing
+        fingerprints = {
+            fingerprint
+            for fingerprint in fingerprints if fingerprint
+        }
+
+        if len(fingerprints) == 0:
+            return set()
+
+        result = self.session.query(Round.fingerprint).filter(
+            Round.fingerprint.in_(fingerprints)).all()
+
+        return {row.fingerprint for row in result}
+
+    def __drop_known_replays__(self, replays):
+        # copies of stored replays and repeats within the batch
+        fingerprints = [
+            getattr(replay, 'fingerprint', None) for replay in replays
+        ]
+        known = self.get_known_fingerprints(fingerprints)
+
+        new_replays = []
+        for replay, fingerprint in zip(replays, fingerprints):
+            if fingerprint:
+                if fingerprint in known:
+                    metrics.count('duplicates_skipped')
+                    continue
+
+                known.add(fingerprint)
+
+            new_replays.append(replay)
+
+        return new_replays
+
+    def __bulk_add_player_stats__(self, player_stats):
+        # player_stats: list of PlayerStats rows, possibly with duplicates
+        stat_columns = ('round_id', 'player_id', 'winner_team', 'kills',
+                        'deaths', 'assists', 'exp_contrib', 'healing',
+                        'damage_soaked')
+
+        if self.__can_upsert__():
+            self.session.execute(
+                sqlite_insert(PlayerStats).on_conflict_do_nothing(),
+                player_stats)
+            return
+
+        result = self.session.query(
+            *[getattr(PlayerStats, column) for column in stat_columns]).filter(
+                PlayerStats.round_id.in_(
+                    {row['round_id']
+                     for row in player_stats})).all()
+        existing = {tuple(row) for row in result}
+
+        missing = []
+        for row in player_stats:
+            key = tuple(row[column] for column in stat_columns)
+            if key in existing:
+                continue
+
+            existing.add(key)
+            missing.append(row)
+
+        if len(missing) > 0:
+            self.session.execute(insert(PlayerStats), missing)
+
+    @staticmethod
+    def __get_timeline_rows__(round_id, player_ids, timeline):
+        # timeline: column lists of Replay.get_metrics_timeline
+        columns = [
+            column for column in timeline.keys() if column != 'blizzard_id'
+        ]
+        player_id_column = [
+            player_ids[blizzard_id] for blizzard_id in timeline['blizzard_id']
+        ]
+
+        return [
+            dict(zip(columns, values), round_id=round_id, player_id=player_id)
+            for player_id, values in zip(
+                player_id_column, zip(*[timeline[column]
+                                        for column in columns]))
+        ]
+
+    def __bulk_add_timeline__(self, timeline_rows):
+        if len(timeline_rows) == 0:
+            return
+
+        if self.__can_upsert__():
+            self.session.execute(
+                sqlite_insert(PlayerStatsTimeline).on_conflict_do_nothing(),
+                timeline_rows)
+            return
+
+        result = self.session.query(
+            PlayerStatsTimeline.round_id, PlayerStatsTimeline.player_id,
+            PlayerStatsTimeline.gameloop).filter(
+                PlayerStatsTimeline.round_id.in_(
+                    {row['round_id']
+                     for row in timeline_rows})).all()
+        existing = {tuple(row) for row in result}
+
+        missing = []
+        for row in timeline_rows:
+            key = (row['round_id'], row['player_id'], row['gameloop'])
+            if key in existing:
+                continue
+
+            existing.add(key)
+            missing.append(row)
+
+        if len(missing) > 0:
+            self.session.execute(insert(PlayerStatsTimeline), missing)
+
+    @staticmethod
+    def __get_season_stats_select__(*filters):
+        return select(
+            PlayerStats.player_id, Match.league, Match.season,
+            func.count(PlayerStats.id),
+            func.sum(cast(PlayerStats.winner_team, Integer)),
+            func.sum(Round.duration),
+            *[func.sum(getattr(PlayerStats, column))
+              for column in STAT_COLUMNS]).join(
+                  Round, PlayerStats.round_id == Round.id).join(
+                      Match, Round.match_id == Match.id).filter(
+                          *filters).group_by(PlayerStats.player_id,
+                                             Match.league, Match.season)
+
+    @staticmethod
+    def __get_season_scores_select__(*filters):
+        return select(
+            PlayerScores.player_id, Match.league, Match.season,
+            func.count(PlayerScores.id),
+            *[func.sum(getattr(PlayerScores, column))
+              for column in SCORE_COLUMNS]).join(
+                  Match, PlayerScores.match_id == Match.id).filter(
+                      *filters).group_by(PlayerScores.player_id,
+                                         Match.league, Match.season)
+
+    def __refresh_season_aggregates__(self, model, base_model, get_select,
+                                      seasons):
+        # seasons: (league, season) -> player ids whose rows are recomputed
+        # from the base tables, within the running transaction
+        columns = [
+            column.name for column in model.__table__.columns
+            if column.name != 'id'
+        ]
+
+        for (league, season), player_ids in seasons.items():
+            self.session.query(model).filter(
+                self.__in__(model.league, [league]),
+                self.__in__(model.season, [season]),
+                model.player_id.in_(player_ids)).delete(
+                    synchronize_session=False)
+
+            self.session.execute(
+                insert(model).from_select(
+                    columns,
+                    get_select(self.__in__(Match.league, [league]),
+                               self.__in__(Match.season, [season]),
+                               base_model.player_id.in_(player_ids))))
+
+    def __refresh_season_stats__(self, seasons):
+        self.__refresh_season_aggregates__(PlayerSeasonStats, PlayerStats,
+                                           self.__get_season_stats_select__,
+                                           seasons)
+
+    def __refresh_season_scores__(self, seasons):
+        self.__refresh_season_aggregates__(PlayerSeasonScores, PlayerScores,
+                                           self.__get_season_scores_select__,
+                                           seasons)
+
+    def __get_score_seasons__(self, rows):
+        # (league, season) -> player ids of PlayerScores rows
+        match_ids = {row['match_id'] for row in rows}
+        result = self.session.query(Match.id, Match.league,
+                                    Match.season).filter(
+                                        Match.id.in_(match_ids)).all()
+        match_seasons = {entry.id: (entry.league, entry.season)
+                         for entry in result}
+
+        seasons = {}
+        for row in rows:
+            season_key = match_seasons.get(row['match_id'])
+            if season_key is not None:
+                seasons.setdefault(season_key, set()).add(row['player_id'])
+
+        return seasons
+
+    def rebuild_season_aggregates(self):
+        # recomputes both aggregate tables from scratch
+        try:
+            for model, get_select in (
+                (PlayerSeasonStats, self.__get_season_stats_select__),
+                (PlayerSeasonScores, self.__get_season_scores_select__)):
+                columns = [
+                    column.name for column in model.__table__.columns
+                    if column.name != 'id'
+                ]
+
+                self.session.query(model).delete(synchronize_session=False)
+                self.session.execute(
+                    insert(model).from_select(columns, get_select()))
 
-            player = self.__get_player__(name=series['player_name'],
-                                         blizzard_id=int(
-                                             series['blizzard_id']))
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def check_season_aggregates(self, rel_tol=1e-9):
+        # keys (table, player_id, league, season) whose stored aggregates
+        # differ from the base tables
+        mismatches = []
+
+        for model, get_select in (
+            (PlayerSeasonStats, self.__get_season_stats_select__),
+            (PlayerSeasonScores, self.__get_season_scores_select__)):
+            columns = [
+                column for column in model.__table__.columns
+                if column.name != 'id'
+            ]
+
+            expected = {
+                tuple(row[:3]): row[3:]
+                for row in self.session.execute(get_select()).all()
+            }
+            stored = {
+                tuple(row[:3]): row[3:]
+                for row in self.session.query(*columns).all()
+            }
+
+            for key in expected.keys() | stored.keys():
+                expected_row = expected.get(key)
+                stored_row = stored.get(key)
+
+                if expected_row is None or stored_row is None or not all(
+                        a == b or (a is not None and b is not None
+                                   and math.isclose(a, b, rel_tol=rel_tol))
+                        for a, b in zip(expected_row, stored_row)):
+                    mismatches.append((model.__tablename__, ) + key)
+
+        return mismatches
+
+    def get_season_standings(self, league, season):
+        # one row per player from the aggregate tables, best total first.
+        # Reads go through the read session like the evaluation queries.
+        stats = PlayerSeasonStats
+        scores = PlayerSeasonScores
+
+        result = self.read_session.query(
+            stats.player_id, stats.rounds_played, stats.wins,
+            stats.minutes_played,
+            *[getattr(stats, column) for column in STAT_COLUMNS],
+            *[(getattr(stats, column) /
+               stats.minutes_played).label(f'{column}_per_min')
+              for column in STAT_COLUMNS], scores.matches_scored,
+            scores.total.label('score_total')).outerjoin(
+                scores,
+                and_(scores.player_id == stats.player_id,
+                     self.__in__(scores.league, [league]),
+                     self.__in__(scores.season, [season]))).filter(
+                         self.__in__(stats.league, [league]),
+                         self.__in__(stats.season, [season])).order_by(
+                             func.coalesce(scores.total, 0).desc(),
+                             stats.player_id).all()
+
+        return [row._asdict() for row in result]
+
+    def add_replays(self, replays):
+        replays = self.__drop_known_replays__(replays)
+        replay_rows = [self.__get_replay_rows__(replay) for replay in replays]
+
+        if len(replay_rows) == 0:
+            return
+
+        # first occurence wins, like the query-then-insert path
+        matches = {}
+        players = {}
+        for match_key, date, _, player_rows, _ in replay_rows:
+            matches.setdefault(match_key, date)
+
+            for row in player_rows:
+                players.setdefault(row['blizzard_id'], row['name'])
+
+        try:
+            match_ids = self.__bulk_get_matches__(matches)
+            player_ids = self.__bulk_get_players__(players)
+
+            # first occurence wins, like matches and players
+            rounds = {}
+            for replay, (match_key, _, round_key, _, _) in zip(
+                    replays, replay_rows):
+                rounds.setdefault((match_ids[match_key], ) + round_key,
+                                  getattr(replay, 'fingerprint', None) or None)
+            round_ids = self.__bulk_get_rounds__(rounds)
+
+            player_stats = []
+            timeline_rows = []
+            for match_key, _, round_key, player_rows, timeline in replay_rows:
+                round_id = round_ids[(match_ids[match_key], ) + round_key]
+
+                timeline_rows += self.__get_timeline_rows__(
+                    round_id, player_ids, timeline)
+
+                for row in player_rows:
+                    player_stats.append({
+                        'round_id': round_id,
+                        'player_id': player_ids[row['blizzard_id']],
+                        'winner_team': row['winner_team'],
+                        'kills': row['kills'],
+                        'deaths': row['deaths'],
+                        'assists': row['assists'],
+                        'exp_contrib': row['exp_contrib'],
+                        'healing': row['healing'],
+                        'damage_soaked': row['damage_soaked']
+                    })
+
+            self.__bulk_add_player_stats__(player_stats)
+            self.__bulk_add_timeline__(timeline_rows)
+
+            seasons = {}
+            for match_key, _, _, player_rows, _ in replay_rows:
+                seasons.setdefault(match_key[:2], set()).update(
+                    player_ids[row['blizzard_id']] for row in player_rows)
+            self.__refresh_season_stats__(seasons)
+
+            self.__bump_generation__()
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
 
-            self.__get_player_stat__(round=round,
-                                     player=player,
-                                     winner_team=series['winner_team'],
-                                     kills=series['kills'],
-                                     deaths=series['deaths'],
-                                     assists=series['assists'],
-                                     exp_contrib=series['exp_contrib'],
-                                     healing=series['healing'],
-                                     damage_soaked=series['damage_soaked'])
+    def add_replay(self, replay):
+        self.add_replays([replay])
+
+    def add_player_scores(self, df, update=False):
+        # df: one row per player and match with player_id, match_id and the
+        # score columns. Existing rows are kept unless update is True.
+        rows = [{
+            'player_id': int(row['player_id']),
+            'match_id': int(row['match_id']),
+            **{column: float(row[column])
+               for column in SCORE_COLUMNS}
+        } for row in df.to_dict(orient='records')]
+
+        if len(rows) == 0:
+            return
+
+        if self.__can_upsert__():
+            self.__upsert_player_scores__(rows=rows,
+                                          score_columns=SCORE_COLUMNS,
+                                          update=update)
+            return
+
+        try:
+            result = self.session.query(
+                PlayerScores.id, PlayerScores.player_id,
+                PlayerScores.match_id).filter(
+                    PlayerScores.match_id.in_(
+                        {row['match_id']
+                         for row in rows})).all()
+
+            score_ids = {}
+            for entry in result:
+                key = (entry.player_id, entry.match_id)
+                if key in score_ids:
+                    raise DataBaseException(
+                        'Ambigious entry. Please contact the developer.')
+                score_ids[key] = entry.id
+
+            new_rows = []
+            updated_rows = []
+            for row in rows:
+                key = (row['player_id'], row['match_id'])
+
+                if key not in score_ids:
+                    # first occurence wins within the batch as well
+                    score_ids[key] = None
+                    new_rows.append(row)
+                elif update and score_ids[key] is not None:
+                    updated_rows.append({'id': score_ids[key], **row})
+
+            if len(new_rows) > 0:
+                self.session.execute(insert(PlayerScores), new_rows)
+
+            if len(updated_rows) > 0:
+                self.session.bulk_update_mappings(PlayerScores, updated_rows)
+
+            self.__refresh_season_scores__(self.__get_score_seasons__(rows))
+
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def __upsert_player_scores__(self, rows, score_columns, update):
+        # first occurence wins within the batch, like the lookup path
+        unique_rows = {}
+        for row in rows:
+            unique_rows.setdefault((row['player_id'], row['match_id']), row)
+
+        statement = sqlite_insert(PlayerScores)
+        if update:
+            statement = statement.on_conflict_do_update(
+                index_elements=['match_id', 'player_id'],
+                set_={
+                    column: statement.excluded[column]
+                    for column in score_columns
+                })
+        else:
+            statement = statement.on_conflict_do_nothing()
+
+        try:
+            self.session.execute(statement, list(unique_rows.values()))
+            self.__refresh_season_scores__(self.__get_score_seasons__(rows))
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
 
-    def add_match_scores(self, match):
+    def add_match_scores(self, match, update=False):
         df = match.get_scores()
         df.reset_index(inplace=True)
+        df['match_id'] = match.id
+
+        self.add_player_scores(df=df, update=update)
+
+    def add_season_scores(self, season, update=False):
+        df = season.get_scores()
+        df.reset_index(inplace=True)
+
+        self.add_player_scores(df=df, update=update)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Maintain a replay DB.')
+    parser.add_argument('db_path')
+    parser.add_argument(
+        'command',
+        choices=('migrate', 'rebuild-aggregates', 'check-aggregates'))
+    args = parser.parse_args(args)
+
+    db = DB(path=args.db_path)
+
+    if args.command == 'migrate':
+        db.migrate()
+    elif args.command == 'rebuild-aggregates':
+        db.rebuild_season_aggregates()
+    else:
+        mismatches = db.check_season_aggregates()
+
+        for table, player_id, league, season in mismatches:
+            print(f'{table}: player {player_id}, league {league}, '
+                  f'season {season} differs from the base tables.')
+
+        if len(mismatches) > 0:
+            raise SystemExit(1)
+
 
-        db_match_entry = self.__get_match_by_id__(id=match.id)
-
-        for i in range(len(df)):
-            data_series = df.iloc[i]
-            player = self.__get_player_by_id__(id=data_series['player_id'])
-
-            self.__get_player_scores__(
-                player=player,
-                match=db_match_entry,
-                kills=data_series['kills'],
-                deaths=data_series['deaths'],
-                assists=data_series['assists'],
-                exp_per_min=data_series['exp_per_min'],
-                healing=data_series['healing'],
-                damage_soaked=data_series['damage_soaked'],
-                winner=data_series['winner'],
-                under_10_mins=data_series['under_10_mins'],
-                under_15_mins=data_series['under_15_mins'],
-                total=data_series['total'])
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,57 @@
 import numpy as np
-import pandas as pd
 from src.db import Player as PlayerDB
 from src.db import Match as MatchDB
 from src.db import Round as RoundDB
 from src.db import PlayerStats as PlayerStatsDB
+from src.metrics import metrics
+
+# points per unit of each score component
+SCORING_TABLE = {
+    'kills': 3,
+    'deaths': -1,
+    'assists': 1.5,
+    'exp_per_min': 0.0075,
+    'healing': 0.0001,
+    'damage_soaked': 0.0001,
+    'winner': 2,
+    'under_10_mins': 5,
+    'under_15_mins': 2
+}
+
+SCORING_ENGINES = ('vectorized', 'row')
+
+# a player's match score is the mean of the best rounds in that match
+TOP_ROUNDS = 3
+MATCH_KEYS = ['league', 'season', 'match']
+
+
+def get_top_rounds_mean(scores_df, group_by, n_rounds=TOP_ROUNDS):
+    # stable sort keeps the earlier round on ties, like nlargest. NULL
+    # league and season are the default, so they form groups as well.
+    top_df = scores_df.sort_values('total', ascending=False, kind='stable')
+    top_df = top_df.groupby(group_by, sort=False, dropna=False).head(n_rounds)
+
+    return top_df.groupby(group_by, dropna=False).mean()
 
 
 class Entity(object):
-    def __init__(self, db):
+    def __init__(self, db, scoring_table=None, scoring_engine='vectorized'):
         self._db = db
 
+        if scoring_engine not in SCORING_ENGINES:
+            raise Exception(
+                f'Unknown scoring engine {scoring_engine}. Choose one of {SCORING_ENGINES}.'
+            )
+        self._scoring_engine = scoring_engine
+        self._scoring_table = SCORING_TABLE if scoring_table is None \
+            else {**SCORING_TABLE, **scoring_table}
+
+        # normalized filter of the entity, set by the subclasses whose
+        # results are cached in db.result_cache
+        self._cache_key = None
+
         # set query
-        self.query = self._db.session.query(PlayerStatsDB).join(
+        self.query = self._db.read_session.query(PlayerStatsDB).join(
             PlayerStatsDB.round).join(RoundDB.match)
         self.query = self.query.add_columns(MatchDB.season,
                                             MatchDB.match_in_season,
@@ -35,28 +75,31 @@ class Entity(object):
 
         return df.rename(columns=new_column_names)
 
-    @staticmethod
-    def __get_individual_scores__(data_series):
+    def __get_individual_scores__(self, data_series):
+        table = self._scoring_table
 
         scores_dict = {
             'kills':
-            3 * data_series.kills,
+            table['kills'] * data_series.kills,
             'deaths':
-            -1 * data_series.deaths,
+            table['deaths'] * data_series.deaths,
             'assists':
-            1.5 * data_series.assists,
+            table['assists'] * data_series.assists,
             'exp_per_min':
-            0.0075 * data_series.exp_contrib / data_series.duration,
+            table['exp_per_min'] * data_series.exp_contrib /
+            data_series.duration,
             'healing':
-            0.0001 * data_series.healing,
+            table['healing'] * data_series.healing,
             'damage_soaked':
-            0.0001 * data_series.damage_soaked,
+            table['damage_soaked'] * data_series.damage_soaked,
             'winner':
-            2 * data_series.winner_team,
+            table['winner'] * data_series.winner_team,
             'under_10_mins':
-            5 * data_series.winner_team * (data_series.duration < 10),
+            table['under_10_mins'] * data_series.winner_team *
+            (data_series.duration < 10),
             'under_15_mins':
-            2 * data_series.winner_team * (10 <= data_series.duration < 15),
+            table['under_15_mins'] * data_series.winner_team *
+            (10 <= data_series.duration < 15),
         }
 
         return scores_dict
@@ -68,13 +111,9 @@ class Entity(object):
 
         return score_dict
 
-    def get_stats(self, filter_query):
-        query = self.query.filter(*filter_query)
-        df = pd.read_sql(query.statement, query.session.bind)
-
-        return self.__prettify_stat_df__(df)
+    def __get_scores_row__(self, df):
+        import pandas as pd
 
-    def get_scores(self, df):
         scores = []
 
         for i in range(len(df)):
@@ -83,10 +122,126 @@ class Entity(object):
 
         return pd.DataFrame(scores)
 
+    def __get_scores_vectorized__(self, df):
+        import pandas as pd
+
+        table = self._scoring_table
+        duration = df['duration']
+        winner = df['winner_team']
+
+        scores_df = pd.DataFrame({
+            'kills':
+            table['kills'] * df['kills'],
+            'deaths':
+            table['deaths'] * df['deaths'],
+            'assists':
+            table['assists'] * df['assists'],
+            'exp_per_min':
+            table['exp_per_min'] * df['exp_contrib'] / duration,
+            'healing':
+            table['healing'] * df['healing'],
+            'damage_soaked':
+            table['damage_soaked'] * df['damage_soaked'],
+            'winner':
+            table['winner'] * winner,
+            'under_10_mins':
+            table['under_10_mins'] * winner * (duration < 10),
+            'under_15_mins':
+            table['under_15_mins'] * winner * ((10 <= duration) &
+                                                (duration < 15)),
+        })
+
+        # row-wise sum over a C-ordered array adds the components in the
+        # same order as np.sum on each row's list
+        components = np.ascontiguousarray(scores_df.to_numpy(dtype=float))
+        scores_df['total'] = np.sum(components, axis=1)
+        scores_df['player_id'] = df['player_id']
+
+        return scores_df.reset_index(drop=True)
+
+    def __get_cached__(self, key, compute):
+        # every result is computed from the stats tables, so it is keyed by
+        # their generation read before computing it. A result computed
+        # while a write commits is stored under the old generation and never
+        # served.
+        generation = self._db.get_generation()
+        if generation is None:
+            return compute()
+
+        cache = self._db.result_cache
+        key = (generation, ) + key
+
+        df = cache.get(key)
+        if df is None:
+            metrics.count('result_cache_misses')
+
+            df = compute()
+            cache.set(key,
+                      df.copy(),
+                      n_bytes=int(df.memory_usage(deep=True).sum()))
+
+            return df
+
+        metrics.count('result_cache_hits')
+
+        # callers modify the frames, e.g. add_match_scores
+        return df.copy()
+
+    def __get_scores_cache_key__(self):
+        return ('scores', self._scoring_engine,
+                tuple(sorted(self._scoring_table.items()))) + self._cache_key
+
+    def get_stats(self, filter_query, cache=True):
+        def compute():
+            import pandas as pd
+
+            query = self.query.filter(*filter_query)
+            df = pd.read_sql(query.statement, query.session.bind)
+
+            return self.__prettify_stat_df__(df)
+
+        # arbitrary filters, e.g. of a Player, are not cached
+        if not cache or self._cache_key is None:
+            return compute()
+
+        return self.__get_cached__(('stats', ) + self._cache_key, compute)
+
+    def get_scores(self, df):
+        if self._scoring_engine == 'row':
+            return self.__get_scores_row__(df)
+
+        return self.__get_scores_vectorized__(df)
+
+    def get_match_scores(self, stats_df, n_rounds=TOP_ROUNDS):
+        # scores of all matches in stats_df, indexed by MATCH_KEYS + player_id
+        df = Entity.get_scores(self, df=stats_df)
+
+        for key in MATCH_KEYS:
+            df[key] = stats_df[key].to_numpy()
+
+        df = get_top_rounds_mean(df,
+                                 group_by=MATCH_KEYS + ['player_id'],
+                                 n_rounds=n_rounds)
+
+        weeks = stats_df.groupby(MATCH_KEYS,
+                                 dropna=False)['date'].first().map(
+            lambda date: date.isocalendar().week)
+        df['week'] = weeks.reindex(df.index.droplevel('player_id')).to_numpy()
+
+        return df
+
 
 class Player(Entity):
-    def __init__(self, db, db_id=None, name=None, blizzard_id=None):
-        super().__init__(db=db)
+    def __init__(self,
+                 db,
+                 db_id=None,
+                 name=None,
+                 blizzard_id=None,
+                 scoring_table=None,
+                 scoring_engine='vectorized'):
+        super().__init__(db=db,
+                         scoring_table=scoring_table,
+                         scoring_engine=scoring_engine)
 
         # get player information
         if db_id is not None:
@@ -99,7 +254,7 @@ class Player(Entity):
             raise Exception(
                 'Need at least one information to identify player.')
 
-        result = self._db.session.query(PlayerDB).filter(*query).all()
+        result = self._db.read_session.query(PlayerDB).filter(*query).all()
 
         # check if found exactly one player in DB
         if len(result) < 1:
@@ -120,14 +275,25 @@ class Player(Entity):
 
 
 class Round(Entity):
-    def __init__(self, league, season_id, match_id, round_id, db):
-        super().__init__(db=db)
+    def __init__(self,
+                 league,
+                 season_id,
+                 match_id,
+                 round_id,
+                 db,
+                 scoring_table=None,
+                 scoring_engine='vectorized'):
+        super().__init__(db=db,
+                         scoring_table=scoring_table,
+                         scoring_engine=scoring_engine)
 
         self.league = league
         self.season = season_id
         self.match = match_id
         self.round = round_id
 
+        self._cache_key = ('round', league, season_id, match_id, round_id)
+
     def get_stats(self):
         return super().get_stats(
             filter_query=(MatchDB.league == self.league,
@@ -136,25 +302,37 @@ class Round(Entity):
                           RoundDB.round_in_match == self.round))
 
     def get_scores(self):
-        stats_df = self.get_stats()
-        df = super().get_scores(df=stats_df)
+        def compute():
+            stats_df = self.get_stats()
+            df = Entity.get_scores(self, df=stats_df)
+
+            return df.set_index('player_id')
 
-        return df.set_index('player_id')
+        return self.__get_cached__(self.__get_scores_cache_key__(), compute)
 
 
 class Match(Entity):
-    def __init__(self, league, season_id, match_id, db):
-        super().__init__(db=db)
+    def __init__(self,
+                 league,
+                 season_id,
+                 match_id,
+                 db,
+                 scoring_table=None,
+                 scoring_engine='vectorized'):
+        super().__init__(db=db,
+                         scoring_table=scoring_table,
+                         scoring_engine=scoring_engine)
 
         self.league = league
         self.season = season_id
         self.match = match_id
 
+        self._cache_key = ('match', league, season_id, match_id, None)
         self._filter_query = (MatchDB.league == self.league,
                               MatchDB.season == self.season,
                               MatchDB.match_in_season == self.match)
 
-        result = self._db.session.query(MatchDB).filter(
+        result = self._db.read_session.query(MatchDB).filter(
             *self._filter_query).all()
 
         # check if found exactly one player in DB
@@ -175,18 +353,60 @@ class Match(Entity):
         return super().get_stats(filter_query=self._filter_query)
 
     def get_scores(self):
-        stats_df = self.get_stats()
-        df = super().get_scores(df=stats_df)
+        def compute():
+            stats_df = self.get_stats()
+            df = self.get_match_scores(stats_df=stats_df)
 
-        week = stats_df['date'][0].isocalendar().week
+            return df.droplevel(MATCH_KEYS)
 
-        df = df.groupby(
-            "player_id",
-            group_keys=False).apply(lambda g: g.nlargest(3, "total"))
-        df = df.groupby("player_id",
-                        group_keys=False).apply(lambda g: g.mean())
-        df['player_id'] = df['player_id'].astype(int)
-        df.set_index('player_id', inplace=True)
-        df['week'] = week
+        return self.__get_cached__(self.__get_scores_cache_key__(), compute)
 
-        return df
+
+class Season(Entity):
+    def __init__(self,
+                 league,
+                 season_id,
+                 db,
+                 scoring_table=None,
+                 scoring_engine='vectorized'):
+        super().__init__(db=db,
+                         scoring_table=scoring_table,
+                         scoring_engine=scoring_engine)
+
+        self.league = league
+        self.season = season_id
+
+        self._cache_key = ('season', league, season_id, None, None)
+        self._filter_query = (MatchDB.league == self.league,
+                              MatchDB.season == self.season)
+
+        result = self._db.read_session.query(
+            MatchDB.id, MatchDB.match_in_season).filter(
+                *self._filter_query).all()
+
+        if len(result) < 1:
+            raise Exception(
+                'No entry found. Please update your search parameters!')
+
+        # match_in_season -> Match.id
+        self.match_ids = {
+            entry.match_in_season: entry.id
+            for entry in result
+        }
+
+    def get_stats(self):
+        return super().get_stats(filter_query=self._filter_query)
+
+    def get_scores(self):
+        def compute():
+            # one stats query for all matches of the season
+            stats_df = self.get_stats()
+            df = self.get_match_scores(stats_df=stats_df)
+
+            df = df.droplevel(['league', 'season'])
+            df['match_id'] = df.index.get_level_values('match').map(
+                self.match_ids)
+
+            return df
+
+        return self.__get_cached__(self.__get_scores_cache_key__(), compute)
@@ -0,0 +1,323 @@
+import os
+import numpy as np
+from src.replay import ReplayParser
+
+EVENT_PREFIX = 'NNet.Replay.Tracker.'
+
+# ids missing in an event, e.g. the killer of a unit that timed out
+MISSING = -1
+
+# dictionary encoded columns store codes and a categories array
+CATEGORIES_SUFFIX = '.categories'
+
+STORE_FORMATS = ('npz', 'parquet')
+
+
+def get_table_name(event_name):
+    # 'NNet.Replay.Tracker.SUnitBornEvent' -> 'SUnitBornEvent'
+    if event_name.startswith(EVENT_PREFIX):
+        return event_name[len(EVENT_PREFIX):]
+
+    return event_name
+
+
+def _get_int_array(values):
+    array = np.array([MISSING if value is None else value for value in values],
+                     dtype=np.int64)
+
+    if len(array) > 0 and array.min() >= np.iinfo(np.int32).min \
+            and array.max() <= np.iinfo(np.int32).max:
+        return array.astype(np.int32)
+
+    return array
+
+
+def _encode_dictionary(values):
+    # codes are indexes into the sorted categories, MISSING for None
+    categories = sorted({value for value in values if value is not None})
+    lookup = {category: code for code, category in enumerate(categories)}
+
+    codes = np.array(
+        [MISSING if value is None else lookup[value] for value in values],
+        dtype=np.int32)
+
+    return codes, np.array(categories, dtype=np.bytes_)
+
+
+def _get_column_kind(values):
+    kinds = {type(value) for value in values if value is not None}
+
+    if len(kinds) == 0:
+        return None
+    if kinds == {bool}:
+        return 'bool'
+    if kinds == {int}:
+        return 'int'
+    if kinds == {bytes}:
+        return 'bytes'
+
+    # nested lists and structs, e.g. m_items or m_instanceList
+    return None
+
+
+class TrackerEventStore(object):
+    def __init__(self, tables, categories=None):
+        # table name -> column name -> array, categories hold the values of
+        # the dictionary encoded columns: (table name, column name) -> array
+        self.tables = tables
+        self.categories = categories or {}
+
+    @classmethod
+    def from_events(cls, events):
+        # only scalar fields become columns, nested ones are dropped
+        rows = {}
+        for event in events:
+            rows.setdefault(event['_event'], []).append(event)
+
+        tables = {}
+        categories = {}
+
+        for event_name, event_rows in rows.items():
+            table_name = get_table_name(event_name)
+            table = {
+                'gameloop':
+                np.array([event['_gameloop'] for event in event_rows],
+                         dtype=np.int32),
+                'eventid':
+                np.array([event['_eventid'] for event in event_rows],
+                         dtype=np.int16)
+            }
+
+            field_names = [
+                key for key in event_rows[0].keys() if not key.startswith('_')
+            ]
+
+            for field_name in field_names:
+                values = [event.get(field_name) for event in event_rows]
+                kind = _get_column_kind(values)
+
+                # m_unitTypeName -> unitTypeName
+                column = field_name[2:] if field_name.startswith('m_') \
+                    else field_name
+
+                if kind == 'int':
+                    table[column] = _get_int_array(values)
+                elif kind == 'bool':
+                    table[column] = np.array(values, dtype=bool)
+                elif kind == 'bytes':
+                    table[column], categories[(table_name, column)] = \
+                        _encode_dictionary(values)
+
+            tables[table_name] = table
+
+        return cls(tables=tables, categories=categories)
+
+    @classmethod
+    def from_replay(cls, replay_path, event_filters=None):
+        # replay_path is anything ReplayParser accepts
+        with ReplayParser(replay_path=replay_path) as replay:
+            return cls.from_events(
+                replay.iter_events(event_type='tracker',
+                                   event_filters=event_filters))
+
+    @classmethod
+    def concat(cls, stores):
+        # stacks the stores of many replays for timeline queries across
+        # them, the replay column holds the index of the store
+        tables = {}
+        categories = {}
+
+        table_names = sorted({
+            table_name
+            for store in stores for table_name in store.tables.keys()
+        })
+
+        for table_name in table_names:
+            parts = [(i, store) for i, store in enumerate(stores)
+                     if table_name in store.tables]
+            columns = [
+                column for column in parts[0][1].tables[table_name].keys()
+                if all(column in store.tables[table_name]
+                       for _, store in parts)
+            ]
+
+            table = {
+                'replay':
+                np.concatenate([
+                    np.full(len(store.tables[table_name]['gameloop']),
+                            i,
+                            dtype=np.int32) for i, store in parts
+                ])
+            }
+
+            for column in columns:
+                key = (table_name, column)
+
+                if key not in parts[0][1].categories:
+                    table[column] = np.concatenate(
+                        [store.tables[table_name][column] for _, store in parts])
+                    continue
+
+                # codes of each store are mapped onto the merged categories
+                merged = np.unique(
+                    np.concatenate(
+                        [store.categories[key] for _, store in parts]))
+                codes = []
+                for _, store in parts:
+                    store_codes = store.tables[table_name][column]
+                    mapping = np.append(
+                        np.searchsorted(merged, store.categories[key]),
+                        MISSING).astype(np.int32)
+                    codes.append(mapping[store_codes])
+
+                table[column] = np.concatenate(codes)
+                categories[key] = merged
+
+            tables[table_name] = table
+
+        return cls(tables=tables, categories=categories)
+
+    def get_table_names(self):
+        return sorted(self.tables.keys())
+
+    def get_table(self, table_name):
+        return self.tables[table_name]
+
+    def get_column(self, table_name, column, decode=False):
+        array = self.tables[table_name][column]
+        categories = self.categories.get((table_name, column))
+
+        if not decode or categories is None:
+            return array
+
+        # MISSING codes decode to b''
+        decoded = np.append(categories, np.array([b''], dtype=np.bytes_))
+
+        return decoded[array]
+
+    def get_codes(self, table_name, column, values):
+        # dictionary codes of values, e.g. unit type names to filter on
+        lookup = {
+            category: code
+            for code, category in enumerate(
+                self.categories[(table_name, column)])
+        }
+
+        return [lookup[value] for value in values if value in lookup]
+
+    def to_dataframe(self, table_name, decode=True):
+        import pandas as pd
+
+        table = self.tables[table_name]
+
+        return pd.DataFrame({
+            column: self.get_column(table_name, column, decode=decode)
+            for column in table.keys()
+        })
+
+    def get_nbytes(self):
+        return sum(array.nbytes for table in self.tables.values()
+                   for array in table.values()) + \
+            sum(array.nbytes for array in self.categories.values())
+
+    def save_npz(self, path):
+        arrays = {}
+
+        for table_name, table in self.tables.items():
+            for column, array in table.items():
+                arrays[f'{table_name}/{column}'] = array
+
+        for (table_name, column), array in self.categories.items():
+            arrays[f'{table_name}/{column}{CATEGORIES_SUFFIX}'] = array
+
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load_npz(cls, path):
+        tables = {}
+        categories = {}
+
+        with np.load(path) as arrays:
+            for key in arrays.files:
+                table_name, column = key.split('/', 1)
+
+                if column.endswith(CATEGORIES_SUFFIX):
+                    column = column[:-len(CATEGORIES_SUFFIX)]
+                    categories[(table_name, column)] = arrays[key]
+                else:
+                    tables.setdefault(table_name, {})[column] = arrays[key]
+
+        return cls(tables=tables, categories=categories)
+
+    def save_parquet(self, directory):
+        # one file per event type, dictionary columns stay dictionary encoded
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        os.makedirs(directory, exist_ok=True)
+
+        for table_name, table in self.tables.items():
+            columns = {}
+
+            for column, array in table.items():
+                categories = self.categories.get((table_name, column))
+
+                if categories is None:
+                    columns[column] = pa.array(array)
+                else:
+                    columns[column] = pa.DictionaryArray.from_arrays(
+                        pa.array(array, mask=array == MISSING),
+                        pa.array(categories, type=pa.binary()))
+
+            pq.write_table(pa.table(columns),
+                           os.path.join(directory, f'{table_name}.parquet'))
+
+    @classmethod
+    def load_parquet(cls, directory):
+        import pyarrow.parquet as pq
+
+        tables = {}
+        categories = {}
+
+        for file_name in sorted(os.listdir(directory)):
+            if not file_name.endswith('.parquet'):
+                continue
+
+            table_name = file_name[:-len('.parquet')]
+            table = pq.read_table(os.path.join(directory, file_name))
+            tables[table_name] = {}
+
+            for column in table.column_names:
+                array = table.column(column).combine_chunks()
+
+                if hasattr(array, 'dictionary'):
+                    tables[table_name][column] = array.indices.fill_null(
+                        MISSING).to_numpy().astype(np.int32)
+                    categories[(table_name, column)] = np.array(
+                        array.dictionary.to_pylist(), dtype=np.bytes_)
+                else:
+                    tables[table_name][column] = array.to_numpy()
+
+        return cls(tables=tables, categories=categories)
+
+    def save(self, path, store_format='npz'):
+        if store_format not in STORE_FORMATS:
+            raise Exception(
+                f'Unknown store format {store_format}. Choose one of {STORE_FORMATS}.'
+            )
+
+        if store_format == 'parquet':
+            self.save_parquet(path)
+        else:
+            self.save_npz(path)
+
+
+def get_store_path(store_dir, replay_file_name, store_format='npz'):
+    # <store_dir>/<replay file name without extension>.npz, or a directory
+    # of parquet files
+    name = os.path.splitext(replay_file_name)[0]
+
+    if store_format == 'npz':
+        return os.path.join(store_dir, f'{name}.npz')
+
+    return os.path.join(store_dir, name)
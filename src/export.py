@@ -0,0 +1,330 @@
+import os
+import json
+import shutil
+import argparse
+from urllib.parse import quote
+from sqlalchemy import Boolean, Date, Float, Integer, String, Time, cast, select
+from src.db import DB, Match, PlayerScores, PlayerStats, Round, SCORE_COLUMNS
+
+EXPORT_FORMATS = ('parquet', 'arrow')
+DATASETS = ('stats', 'scores')
+
+FILE_EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+# value of NULL partition keys, as in Hive and pyarrow.dataset
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+# dataset -> last exported id, kept in the output directory
+STATE_FILE = 'export_state.json'
+
+
+def _get_stats_select():
+    # Round.duration holds minutes as floats despite its Integer type
+    return select(PlayerStats.id, PlayerStats.player_id, Match.league,
+                  Match.season, Match.id.label('match_id'),
+                  Match.match_in_season.label('match'), Match.date,
+                  Round.id.label('round_id'),
+                  Round.round_in_match.label('round'), Round.map_name,
+                  cast(Round.duration, Float).label('duration'), Round.time,
+                  PlayerStats.winner_team, PlayerStats.kills,
+                  PlayerStats.deaths, PlayerStats.assists,
+                  PlayerStats.exp_contrib, PlayerStats.healing,
+                  PlayerStats.damage_soaked).join(
+                      Round, PlayerStats.round_id == Round.id).join(
+                          Match, Round.match_id == Match.id)
+
+
+def _get_scores_select():
+    return select(PlayerScores.id, PlayerScores.player_id, Match.league,
+                  Match.season, Match.id.label('match_id'),
+                  Match.match_in_season.label('match'), Match.date,
+                  *[getattr(PlayerScores, column)
+                    for column in SCORE_COLUMNS]).join(
+                        Match, PlayerScores.match_id == Match.id)
+
+
+# dataset -> (select, id column used for incremental exports)
+_DATASET_SELECTS = {
+    'stats': (_get_stats_select, PlayerStats.id),
+    'scores': (_get_scores_select, PlayerScores.id)
+}
+
+
+def _get_arrow_type(column_type):
+    import pyarrow as pa
+
+    arrow_types = [(Boolean, pa.bool_()), (Integer, pa.int64()),
+                   (Float, pa.float64()), (String, pa.string()),
+                   (Date, pa.date32()), (Time, pa.time64('us'))]
+
+    for sql_type, arrow_type in arrow_types:
+        if isinstance(column_type, sql_type):
+            return arrow_type
+
+    raise Exception(f'No arrow type for {column_type}.')
+
+
+def get_schema(statement):
+    import pyarrow as pa
+
+    return pa.schema([(column.name, _get_arrow_type(column.type))
+                      for column in statement.selected_columns])
+
+
+def get_partition_dir(league, season):
+    # league=<league>/season=<season>, readable by pyarrow.dataset with
+    # partitioning='hive'
+    values = [
+        NULL_PARTITION if value is None else quote(str(value), safe='')
+        for value in (league, season)
+    ]
+
+    return os.path.join(f'league={values[0]}', f'season={values[1]}')
+
+
+def _get_batch(columns, schema, start, end):
+    import pyarrow as pa
+
+    return pa.RecordBatch.from_arrays([
+        pa.array(column[start:end], type=field.type)
+        for column, field in zip(columns, schema)
+    ],
+                                      schema=schema)
+
+
+class _PartWriter(object):
+    # one parquet or arrow ipc file, written batch by batch
+    def __init__(self, path, schema, export_format):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.n_rows = 0
+
+        if export_format == 'parquet':
+            self._writer = pq.ParquetWriter(path, schema)
+        else:
+            self._writer = pa.ipc.new_file(path, schema)
+
+    def write(self, batch):
+        self._writer.write_batch(batch)
+        self.n_rows += batch.num_rows
+
+    def close(self):
+        self._writer.close()
+
+
+def load_state(output_dir):
+    path = os.path.join(output_dir, STATE_FILE)
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(output_dir, state):
+    # written to a temporary file first, a crash keeps the old state
+    path = os.path.join(output_dir, STATE_FILE)
+
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+    os.replace(f'{path}.tmp', path)
+
+
+def export_dataset(db,
+                   dataset,
+                   output_dir,
+                   export_format='parquet',
+                   chunk_size=50000,
+                   partition=False,
+                   since_id=None,
+                   part_name='part-00000'):
+    # Streams the rows of dataset with an id above since_id into
+    # <output_dir>/<dataset>[/league=../season=..]/<part_name>.<ext>. Only
+    # one chunk of rows is in memory at a time. Returns the highest id
+    # exported, or since_id if there were no new rows, and the files
+    # written.
+    import pyarrow as pa
+
+    if dataset not in DATASETS:
+        raise Exception(f'Unknown dataset {dataset}. Choose one of {DATASETS}.')
+    if export_format not in EXPORT_FORMATS:
+        raise Exception(
+            f'Unknown export format {export_format}. Choose one of {EXPORT_FORMATS}.'
+        )
+
+    get_select, id_column = _DATASET_SELECTS[dataset]
+    statement = get_select()
+
+    if since_id is not None:
+        statement = statement.filter(id_column > since_id)
+
+    # partitions are contiguous, so only one file is open at a time
+    if partition:
+        statement = statement.order_by(Match.league, Match.season, id_column)
+    else:
+        statement = statement.order_by(id_column)
+
+    schema = get_schema(statement)
+    names = schema.names
+
+    # partition keys are stored in the directory names only
+    file_fields = [
+        i for i, name in enumerate(names)
+        if not partition or name not in ('league', 'season')
+    ]
+    file_schema = pa.schema([schema.field(i) for i in file_fields])
+
+    file_name = f'{part_name}.{FILE_EXTENSIONS[export_format]}'
+
+    last_id = since_id
+    writer = None
+    writer_key = None
+    paths = []
+
+    def get_writer(league, season):
+        nonlocal writer, writer_key
+
+        key = (league, season) if partition else None
+        if writer is not None and key == writer_key:
+            return writer
+
+        if writer is not None:
+            writer.close()
+
+        directory = os.path.join(output_dir, dataset)
+        if partition:
+            directory = os.path.join(directory,
+                                     get_partition_dir(league, season))
+
+        writer = _PartWriter(os.path.join(directory, file_name),
+                             file_schema, export_format)
+        writer_key = key
+        paths.append(writer.path)
+
+        return writer
+
+    with db.read_engine.connect() as connection:
+        result = connection.execution_options(yield_per=chunk_size).execute(
+            statement)
+
+        try:
+            for rows in result.partitions(chunk_size):
+                columns = list(zip(*rows))
+                file_columns = [columns[i] for i in file_fields]
+
+                if partition:
+                    # a chunk can span partitions, split it at the changes
+                    keys = list(zip(columns[names.index('league')],
+                                    columns[names.index('season')]))
+                    start = 0
+                    for end in range(1, len(rows) + 1):
+                        if end < len(rows) and keys[end] == keys[start]:
+                            continue
+
+                        get_writer(*keys[start]).write(
+                            _get_batch(file_columns, file_schema, start,
+                                       end))
+                        start = end
+                else:
+                    get_writer(None, None).write(
+                        _get_batch(file_columns, file_schema, 0, len(rows)))
+
+                chunk_last_id = max(columns[names.index('id')])
+                last_id = chunk_last_id if last_id is None \
+                    else max(last_id, chunk_last_id)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    return last_id, paths
+
+
+def export(db,
+           output_dir,
+           datasets=DATASETS,
+           export_format='parquet',
+           chunk_size=50000,
+           partition=False,
+           incremental=False):
+    # Incremental runs only export the rows added since the last run into
+    # new part files. Rows changed in place, e.g. scores re-added with
+    # update=True, are only exported by a full run.
+    os.makedirs(output_dir, exist_ok=True)
+
+    # the state of the datasets not exported in this run is kept, and run
+    # numbers keep increasing so part files are never reused
+    state = load_state(output_dir)
+
+    # a full run replaces the files of earlier runs of its datasets
+    if not incremental:
+        for dataset in datasets:
+            shutil.rmtree(os.path.join(output_dir, dataset),
+                          ignore_errors=True)
+            state.pop(dataset, None)
+    run = state.get('run', -1) + 1
+    paths = []
+
+    for dataset in datasets:
+        last_id, dataset_paths = export_dataset(
+            db=db,
+            dataset=dataset,
+            output_dir=output_dir,
+            export_format=export_format,
+            chunk_size=chunk_size,
+            partition=partition,
+            since_id=state.get(dataset),
+            part_name=f'part-{run:05d}')
+
+        if last_id is not None:
+            state[dataset] = last_id
+        paths += dataset_paths
+
+    state['run'] = run
+    save_state(output_dir, state)
+
+    return paths
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Export player stats and scores to parquet or arrow.')
+    parser.add_argument('db_path')
+    parser.add_argument('output_dir')
+    parser.add_argument('--datasets',
+                        nargs='+',
+                        choices=DATASETS,
+                        default=list(DATASETS))
+    parser.add_argument('--format',
+                        choices=EXPORT_FORMATS,
+                        default='parquet',
+                        dest='export_format')
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    parser.add_argument('--partition',
+                        action='store_true',
+                        help='one directory per league and season')
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='only export the rows added since the last run')
+    args = parser.parse_args(args)
+
+    db = DB(path=args.db_path)
+
+    paths = export(db=db,
+                   output_dir=args.output_dir,
+                   datasets=args.datasets,
+                   export_format=args.export_format,
+                   chunk_size=args.chunk_size,
+                   partition=args.partition,
+                   incremental=args.incremental)
+
+    print(f'Wrote {len(paths)} files to {args.output_dir}.')
+
+
+if __name__ == '__main__':
+    main()
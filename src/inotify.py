@@ -0,0 +1,154 @@
+import os
+import sys
+import ctypes
+import ctypes.util
+import struct
+
+# see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# a file counts as added once it is completely written or moved in
+ADDED_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+REMOVED_MASK = IN_DELETE | IN_MOVED_FROM
+WATCH_MASK = ADDED_MASK | REMOVED_MASK | IN_DELETE_SELF | IN_MOVE_SELF | \
+    IN_ONLYDIR
+
+# the watched directory was deleted or moved away, the watch is gone or
+# follows the moved directory
+WATCH_LOST_MASK = IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED
+
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+    except OSError:
+        return None
+
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+
+    return libc
+
+
+_libc = _load_libc()
+
+
+class INotifyException(Exception):
+    pass
+
+
+class INotify(object):
+    def __init__(self, path):
+        if not self.is_supported():
+            raise INotifyException('inotify is not supported on this system.')
+
+        self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self._path = path
+        self._watch = -1
+
+        try:
+            self.__add_watch__()
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def __add_watch__(self):
+        watch = _libc.inotify_add_watch(self._fd, os.fsencode(self._path),
+                                        WATCH_MASK)
+        if watch < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), self._path)
+
+        self._watch = watch
+
+    def __remove_watch__(self):
+        # fails for a deleted directory, the kernel removed the watch already
+        _libc.inotify_rm_watch(self._fd, self._watch)
+        self._watch = -1
+
+    @staticmethod
+    def is_supported():
+        return _libc is not None
+
+    def is_watching(self):
+        # False while the watched directory does not exist
+        return self._watch >= 0
+
+    def fileno(self):
+        # readable once changes are queued, e.g. for select or asyncio
+        return self._fd
+
+    def read_changes(self):
+        # returns ({file_name: exists}, rescan), the last event per file wins.
+        # A lost watch is added again once the path is a directory again.
+        changes = {}
+        rescan = False
+
+        while True:
+            try:
+                data = os.read(self._fd, READ_SIZE)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                watch, mask, _, length = EVENT_HEADER.unpack_from(
+                    data, offset)
+                offset += EVENT_HEADER.size
+
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    rescan = True
+                elif watch != self._watch:
+                    # left over events of a lost watch
+                    continue
+                elif mask & WATCH_LOST_MASK:
+                    self.__remove_watch__()
+                    rescan = True
+                elif mask & IN_ISDIR:
+                    continue
+                elif mask & ADDED_MASK:
+                    changes[name] = True
+                elif mask & REMOVED_MASK:
+                    changes[name] = False
+
+        if self._watch < 0:
+            try:
+                self.__add_watch__()
+            except (FileNotFoundError, NotADirectoryError):
+                return changes, rescan
+
+            # changes before the watch was added are only found by a scan
+            rescan = True
+
+        return changes, rescan
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
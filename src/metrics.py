@@ -0,0 +1,200 @@
+import json
+import logging
+import threading
+from time import perf_counter
+from contextlib import contextmanager, nullcontext
+
+METRICS_PREFIX = 'replay_parser'
+
+logger = logging.getLogger(METRICS_PREFIX)
+
+# shared no-op so disabled timers don't allocate
+_NULL_TIMER = nullcontext()
+
+
+def log_replay(record):
+    # hook writing one json line per replay
+    logger.info(json.dumps(record, sort_keys=True))
+
+
+class Metrics(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+
+        # stage -> [count, total secs, max secs], counter name -> value
+        self._stages = {}
+        self._counters = {}
+        self._hooks = []
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def add_hook(self, hook):
+        # hook(record) is called with every finished replay record
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+
+    def __get_record__(self):
+        return getattr(self._local, 'record', None)
+
+    def __add_stage__(self, stage, count, secs, max_secs):
+        with self._lock:
+            stats = self._stages.get(stage)
+
+            if stats is None:
+                self._stages[stage] = [count, secs, max_secs]
+            else:
+                stats[0] += count
+                stats[1] += secs
+                stats[2] = max(stats[2], max_secs)
+
+    def __add_counter__(self, name, value):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def timer(self, stage):
+        if not self.enabled:
+            return _NULL_TIMER
+
+        return self.__time__(stage)
+
+    @contextmanager
+    def __time__(self, stage):
+        start = perf_counter()
+
+        try:
+            yield
+        finally:
+            secs = perf_counter() - start
+
+            # within a replay the totals are updated once it ends
+            record = self.__get_record__()
+            if record is None:
+                self.__add_stage__(stage, 1, secs, secs)
+            else:
+                stats = record['stages'].setdefault(stage, {
+                    'count': 0,
+                    'secs': 0.0,
+                    'max_secs': 0.0
+                })
+                stats['count'] += 1
+                stats['secs'] += secs
+                stats['max_secs'] = max(stats['max_secs'], secs)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+
+        record = self.__get_record__()
+        if record is None:
+            self.__add_counter__(name, value)
+        else:
+            record['counters'][name] = record['counters'].get(name, 0) + value
+
+    def begin_replay(self, name, record=None):
+        # record continues a detached replay, e.g. parsed in a worker
+        # process and written to the DB here
+        if not self.enabled:
+            return
+
+        if record is None:
+            record = {'replay': name, 'stages': {}, 'counters': {}}
+
+        self._local.record = record
+
+    def end_replay(self, error=None):
+        record = self.__get_record__()
+        self._local.record = None
+
+        if record is None:
+            return None
+
+        if error is not None:
+            record['error'] = repr(error)
+
+        for stage, stats in record['stages'].items():
+            self.__add_stage__(stage, stats['count'], stats['secs'],
+                               stats['max_secs'])
+        for name, value in record['counters'].items():
+            self.__add_counter__(name, value)
+
+        for hook in self._hooks:
+            hook(record)
+
+        return record
+
+    def detach_replay(self):
+        # ends the replay without counting it, the returned record is handed
+        # to begin_replay, possibly of another process
+        record = self.__get_record__()
+        self._local.record = None
+
+        return record
+
+    @contextmanager
+    def replay(self, name, record=None):
+        self.begin_replay(name, record=record)
+
+        try:
+            yield
+        except Exception as e:
+            self.end_replay(error=e)
+            raise
+
+        self.end_replay()
+
+    def get_stats(self):
+        with self._lock:
+            stages = {
+                stage: {
+                    'count': count,
+                    'secs': secs,
+                    'max_secs': max_secs
+                }
+                for stage, (count, secs, max_secs) in self._stages.items()
+            }
+
+            return {'stages': stages, 'counters': dict(self._counters)}
+
+    def to_prometheus(self):
+        stats = self.get_stats()
+        lines = []
+
+        stage_metric = f'{METRICS_PREFIX}_stage_seconds'
+        lines.append(f'# TYPE {stage_metric} summary')
+        for stage, stage_stats in sorted(stats['stages'].items()):
+            lines.append(
+                f'{stage_metric}_sum{{stage="{stage}"}} {stage_stats["secs"]}')
+            lines.append(
+                f'{stage_metric}_count{{stage="{stage}"}} {stage_stats["count"]}'
+            )
+
+        max_metric = f'{METRICS_PREFIX}_stage_max_seconds'
+        lines.append(f'# TYPE {max_metric} gauge')
+        for stage, stage_stats in sorted(stats['stages'].items()):
+            lines.append(
+                f'{max_metric}{{stage="{stage}"}} {stage_stats["max_secs"]}')
+
+        for name, value in sorted(stats['counters'].items()):
+            counter_metric = f'{METRICS_PREFIX}_{name}_total'
+            lines.append(f'# TYPE {counter_metric} counter')
+            lines.append(f'{counter_metric} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+# process wide registry, disabled by default
+metrics = Metrics()
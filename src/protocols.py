@@ -0,0 +1,51 @@
+import threading
+import heroprotocol.versions as protocol_versions
+
+# base build -> protocol module, filled on first use or by warm_protocols
+_protocols = {}
+_latest_build = None
+_lock = threading.Lock()
+
+
+def get_available_builds():
+    return [
+        int(file_name[len('protocol'):-len('.py')])
+        for file_name in protocol_versions.list_all()
+    ]
+
+
+def get_latest_build():
+    global _latest_build
+
+    # list_all reads the versions directory, only do it once per process
+    if _latest_build is None:
+        _latest_build = get_available_builds()[-1]
+
+    return _latest_build
+
+
+def get_protocol(base_build):
+    protocol = _protocols.get(base_build)
+
+    if protocol is not None:
+        return protocol
+
+    with _lock:
+        # raises ImportError for builds heroprotocol doesn't know
+        if base_build not in _protocols:
+            _protocols[base_build] = protocol_versions.build(base_build)
+
+    return _protocols[base_build]
+
+
+def get_latest_protocol():
+    return get_protocol(get_latest_build())
+
+
+def warm_protocols(builds=None):
+    # imports the protocols of builds (and the latest one used to decode
+    # headers) up front, e.g. in the parent process before workers fork
+    builds = set(builds or ())
+    builds.add(get_latest_build())
+
+    return {build: get_protocol(build) for build in sorted(builds)}
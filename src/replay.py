@@ -1,33 +1,272 @@
+import io
+import os
+import mmap
+import hashlib
 import mpyq
-import pandas as pd
-import heroprotocol.versions as protocol_versions
+from heroprotocol.decoders import CorruptedError, VersionedDecoder
+from src.metrics import metrics
+from src.protocols import get_latest_protocol, get_protocol
+
+GATES_OPEN_EVENT = b'GatesOpen'
+CORE_UNIT_NAMES = (b'KingsCore', b'VanndarStormpike', b'DrekThar')
+
+STAT_GAME_EVENT = 'NNet.Replay.Tracker.SStatGameEvent'
+UNIT_BORN_EVENT = 'NNet.Replay.Tracker.SUnitBornEvent'
+UNIT_INIT_EVENT = 'NNet.Replay.Tracker.SUnitInitEvent'
+UNIT_TYPE_CHANGE_EVENT = 'NNet.Replay.Tracker.SUnitTypeChangeEvent'
+UNIT_DIED_EVENT = 'NNet.Replay.Tracker.SUnitDiedEvent'
+SCORE_RESULT_EVENT = 'NNet.Replay.Tracker.SScoreResultEvent'
+
+DURATION_ENGINES = ('single_pass', 'pandas')
+
+# tracker event fields the duration engines query
+DURATION_COLUMNS = ('_event', '_gameloop', 'm_eventName', 'm_unitTypeName',
+                    'm_unitTagIndex')
+
+# score metric -> column of the metrics timeline
+TIMELINE_METRICS = {
+    b'SoloKill': 'kills',
+    b'Deaths': 'deaths',
+    b'Assists': 'assists',
+    b'ExperienceContribution': 'exp_contrib',
+    b'Healing': 'healing',
+    b'DamageSoaked': 'damage_soaked'
+}
+
+
+BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+
+
+def get_utc_time(details):
+    # m_timeUTC is a Windows file time, 100ns steps since 1601
+    return int(details['m_timeUTC'] / 10**7 - 11644473600)
+
+
+def keep_event(event, event_filters):
+    # event_filters maps event names (e.g. UNIT_DIED_EVENT) to a predicate
+    # or None to keep every event of that name
+    if event.get('_event') not in event_filters:
+        return False
+
+    event_filter = event_filters[event['_event']]
+
+    return event_filter is None or event_filter(event)
+
+
+def read_replay_bytes(replay):
+    # a replay path, buffer or binary file object as a buffer
+    if isinstance(replay, BUFFER_TYPES):
+        return replay
+
+    if isinstance(replay, io.BytesIO):
+        return replay.getbuffer()
+
+    if hasattr(replay, 'read'):
+        replay.seek(0)
+        return replay.read()
+
+    with open(replay, 'rb') as f:
+        return f.read()
+
+
+def get_replay_fingerprint(replay, chunk_size=1024**2):
+    # sha256 of the replay bytes, the digest the watchdog and the cache use.
+    # Paths and file objects are read in chunks, never as a whole.
+    if isinstance(replay, BUFFER_TYPES + (io.BytesIO, )):
+        return hashlib.sha256(read_replay_bytes(replay)).hexdigest()
+
+    fingerprint = hashlib.sha256()
+
+    if hasattr(replay, 'read'):
+        replay.seek(0)
+        for chunk in iter(lambda: replay.read(chunk_size), b''):
+            fingerprint.update(chunk)
+    else:
+        with open(replay, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                fingerprint.update(chunk)
+
+    return fingerprint.hexdigest()
+
+
+class BufferReader(object):
+    # Read-only file object over a buffer such as bytes or an mmap. Reads
+    # only copy the requested range and never move the position of a
+    # shared mmap, so many parsers can read the same buffer.
+    def __init__(self, buffer):
+        self._buffer = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def read(self, size=-1):
+        start = self._position
+        end = len(self._buffer) if size is None or size < 0 \
+            else min(start + size, len(self._buffer))
+        self._position = max(start, end)
+
+        return bytes(self._buffer[start:end])
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self._buffer)
+
+        self._position = max(offset, 0)
+
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self._buffer.release()
 
 
 class ReplayParser(object):
     def __init__(self, replay_path):
-        self.archive = mpyq.MPQArchive(replay_path)
+        # replay_path is a path, a buffer (bytes, memoryview, mmap) or a
+        # binary file object, e.g. a member of a tar bundle
+        self._mapped = None
+        self._reader = None
+
+        if isinstance(replay_path, BUFFER_TYPES):
+            self._reader = BufferReader(replay_path)
+            replay_file = self._reader
+        elif hasattr(replay_path, 'read'):
+            replay_file = replay_path
+        else:
+            # only the pages of the inner files read below are loaded
+            with open(replay_path, 'rb') as f:
+                self._mapped = mmap.mmap(f.fileno(),
+                                         0,
+                                         access=mmap.ACCESS_READ)
+            self._reader = BufferReader(self._mapped)
+            replay_file = self._reader
+
+        # a file that is not a valid replay must not leak the mapping
+        try:
+            self.__open__(replay_file)
+        except Exception:
+            self.close()
+            raise
+
+    def __open__(self, replay_file):
+        # the (listfile) is never needed, files are looked up by name
+        with metrics.timer('mpq_open'):
+            self.archive = mpyq.MPQArchive(replay_file, listfile=False)
 
         # Read Header
         contents = self.archive.header['user_data_header']['content']
-        self.header = protocol_versions.latest().decode_replay_header(contents)
+        metrics.count('bytes_read', len(contents))
+        self.header = get_latest_protocol().decode_replay_header(contents)
 
         # Determine protocol version
         base_build = self.header['m_version']['m_baseBuild']
-        self.protocol = protocol_versions.build(base_build)
+        with metrics.timer('protocol_build'):
+            self.protocol = get_protocol(base_build)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+        if self._mapped is not None:
+            self._mapped.close()
+            self._mapped = None
+
+    def __read_file__(self, file_name):
+        with metrics.timer('mpq_read'):
+            contents = self.archive.read_file(file_name)
+
+        metrics.count('bytes_read', len(contents))
+
+        return contents
 
     def get_header(self):
         return self.header
 
     def get_details(self):
-        contents = self.archive.read_file('replay.details')
+        contents = self.__read_file__('replay.details')
 
-        return self.protocol.decode_replay_details(contents)
+        with metrics.timer('decode_details'):
+            return self.protocol.decode_replay_details(contents)
 
     def get_init_data(self):
-        contents = self.archive.read_file('replay.initData')
+        contents = self.__read_file__('replay.initData')
 
         return self.protocol.decode_replay_initdata(contents)
 
+    def __decode_tracker_events__(self, contents, event_filters):
+        # Same stream layout as heroprotocol's _decode_event_stream, but
+        # events that are filtered out are skipped without building dicts
+        decoder = VersionedDecoder(contents, self.protocol.typeinfos)
+        event_types = self.protocol.tracker_event_types
+        gameloop = 0
+        n_decoded = 0
+        n_skipped = 0
+
+        while not decoder.done():
+            start_bits = decoder.used_bits()
+
+            delta = decoder.instance(self.protocol.svaruint32_typeid)
+            gameloop += next(iter(delta.values()), 0)
+
+            eventid = decoder.instance(self.protocol.tracker_eventid_typeid)
+            typeid, typename = event_types.get(eventid, (None, None))
+            if typeid is None:
+                raise CorruptedError(f'eventid({eventid}) at {decoder}')
+
+            if event_filters is not None and typename not in event_filters:
+                decoder._skip_instance()
+                decoder.byte_align()
+                n_skipped += 1
+                continue
+
+            event = decoder.instance(typeid)
+            event['_event'] = typename
+            event['_eventid'] = eventid
+            event['_gameloop'] = gameloop
+
+            decoder.byte_align()
+            event['_bits'] = decoder.used_bits() - start_bits
+            n_decoded += 1
+
+            yield event
+
+        metrics.count('events_decoded', n_decoded)
+        metrics.count('events_skipped', n_skipped)
+
+    def iter_events(self, event_type='tracker', event_filters=None, stop=None):
+        # event_filters maps event names (e.g. UNIT_DIED_EVENT) to a predicate
+        # or None to keep every event of that name. stop ends decoding after
+        # the first event it returns True for.
+        event_attr = f'decode_replay_{event_type}_events'
+        if not hasattr(self.protocol, event_attr):
+            return
+
+        contents = self.__read_file__(f'replay.{event_type}.events')
+
+        if event_type == 'tracker' and hasattr(self.protocol, 'typeinfos'):
+            events = self.__decode_tracker_events__(contents, event_filters)
+        else:
+            events = getattr(self.protocol, event_attr)(contents)
+
+        for event in events:
+            if event_filters is not None and not keep_event(
+                    event, event_filters):
+                continue
+
+            yield event
+
+            if stop is not None and stop(event):
+                return
+
     def get_events(self,
                    event_types=['game', 'message', 'tracker', 'attributes']):
         events = {}
@@ -37,13 +276,7 @@ class ReplayParser(object):
             if not hasattr(self.protocol, event_attr):
                 continue
 
-            events[event_type] = []
-
-            contents = self.archive.read_file(f'replay.{event_type}.events')
-            result = getattr(self.protocol, event_attr)
-
-            for event in result(contents):
-                events[event_type].append(event)
+            events[event_type] = list(self.iter_events(event_type=event_type))
 
         return events
 
@@ -54,31 +287,183 @@ class Replay(object):
                  league=None,
                  season=None,
                  match_id=None,
-                 round_id=None):
+                 round_id=None,
+                 duration_engine='single_pass',
+                 cache=None,
+                 fingerprint=None,
+                 keep_all_events=False):
         self.league = league
         self.season = season
         self.match_id = match_id
         self.round_id = round_id
 
-        replay = ReplayParser(replay_path=replay_path)
+        # identifies copies of the file, e.g. the watchdog fingerprint, and
+        # keys the cache. Hashing reads the whole file, so it only happens
+        # for the cache or once the fingerprint is read, see fingerprint.
+        self._fingerprint = fingerprint or None
+        self._replay_path = replay_path
+
+        if duration_engine not in DURATION_ENGINES:
+            raise Exception(
+                f'Unknown duration engine {duration_engine}. Choose one of {DURATION_ENGINES}.'
+            )
+        self._duration_engine = duration_engine
 
-        self._header = replay.header
-        self._details = replay.get_details()
+        # every decoded tracker event, e.g. for the event store, None on a
+        # cache hit
+        self.all_tracker_events = None
 
-        events = replay.get_events(event_types=['tracker'])
-        self._tracker_events = events['tracker']
+        # Look up the replay summary in the cache
+        self._summary = None
+
+        if cache is not None:
+            cache_key = cache.get_digest_key(self.fingerprint)
+            self._summary = cache.get(cache_key)
+            metrics.count('cache_misses' if self._summary is None else
+                          'cache_hits')
+
+        if self._summary is not None:
+            self._header = self._summary['header']
+            self._details = self._summary['details']
+            self._tracker_events = None
+
+            self.map_name = self._summary['map_name']
+            self.utc_time = self._summary['utc_time']
+            self.duration = self._summary['duration']
+
+            return
+
+        with ReplayParser(replay_path=replay_path) as replay:
+            self._header = replay.header
+            self._details = replay.get_details()
+
+            with metrics.timer('decode_events'):
+                self._tracker_events = self.__get_tracker_events__(
+                    replay, keep_all_events=keep_all_events)
 
         # Get Replay Information
         self.map_name = self._details['m_title'].decode('utf-8')
         self.utc_time = self.__get_utc_time__()
-        self.duration = self.__get_duration__()
+        with metrics.timer('duration'):
+            self.duration = self.__get_duration__()
+
+        if cache is not None:
+            cache.put(cache_key, self.get_summary())
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = get_replay_fingerprint(self._replay_path)
+            self._replay_path = None
+
+        return self._fingerprint
+
+    def __get_tracker_events__(self, replay, keep_all_events=False):
+        # Only keep the events needed for duration and metrics: GatesOpen,
+        # the core units and their deaths, the last unit death and the
+        # final score result.
+        is_core = lambda event: event['m_unitTypeName'] in CORE_UNIT_NAMES
+        event_filters = {
+            STAT_GAME_EVENT:
+            lambda event: event['m_eventName'] == GATES_OPEN_EVENT,
+            UNIT_BORN_EVENT: is_core,
+            UNIT_INIT_EVENT: is_core,
+            UNIT_TYPE_CHANGE_EVENT: is_core,
+            UNIT_DIED_EVENT: None,
+            SCORE_RESULT_EVENT: None
+        }
+
+        tracker_events = []
+        core_tags = set()
+        self._last_unit_death = None
+
+        # keeping all events decodes the whole stream, the filters are then
+        # applied here
+        if keep_all_events:
+            self.all_tracker_events = []
+            events = replay.iter_events(event_type='tracker')
+        else:
+            events = replay.iter_events(event_type='tracker',
+                                        event_filters=event_filters)
+
+        for event in events:
+            if keep_all_events:
+                self.all_tracker_events.append(event)
+
+                if not keep_event(event, event_filters):
+                    continue
+
+            if event['_event'] == UNIT_DIED_EVENT:
+                self._last_unit_death = event
+
+                if event['m_unitTagIndex'] not in core_tags:
+                    continue
+            elif 'm_unitTypeName' in event:
+                core_tags.add(event['m_unitTagIndex'])
+
+            tracker_events.append(event)
+
+        metrics.count('events_kept', len(tracker_events))
+
+        return tracker_events
 
     def __get_utc_time__(self):
-        return int(self._details['m_timeUTC'] / 10**7 - 11644473600)
+        return get_utc_time(self._details)
 
     def __get_duration__(self):
+        if self._duration_engine == 'pandas':
+            return self.__get_duration_pandas__()
+
+        return self.__get_duration_single_pass__()
+
+    def __get_duration_single_pass__(self):
+        start_gameloop = None
+        core_counts = {}
+        died_counts = {}
+        died_gameloops = {}
+
+        for event in self._tracker_events:
+            if event['_event'] == UNIT_DIED_EVENT:
+                tag = event['m_unitTagIndex']
+                died_counts[tag] = died_counts.get(tag, 0) + 1
+                died_gameloops[tag] = event['_gameloop']
+            elif event.get('m_unitTypeName') in CORE_UNIT_NAMES:
+                tag = event['m_unitTagIndex']
+                core_counts[tag] = core_counts.get(tag, 0) + 1
+            elif start_gameloop is None and \
+                    event.get('m_eventName') == GATES_OPEN_EVENT:
+                start_gameloop = event['_gameloop']
+
+        if start_gameloop is None:
+            raise Exception('No GatesOpen event found in replay.')
+
+        # same row count as merging core events with unit deaths on the tag
+        died_cores = [tag for tag in core_counts if tag in died_counts]
+        n_died_cores = sum(core_counts[tag] * died_counts[tag]
+                           for tag in died_cores)
+
+        if n_died_cores == 0:
+            final_gameloop = self._last_unit_death['_gameloop']
+        elif n_died_cores == 1:
+            final_gameloop = died_gameloops[died_cores[0]]
+        else:
+            raise Exception(
+                "Multiple cores died. It's either due to a bug in your replay file or the software."
+            )
+
+        match_length = final_gameloop - start_gameloop
+
+        return int(match_length / 16)
+
+    def __get_duration_pandas__(self):
+        import pandas as pd
+
         df = pd.DataFrame(self._tracker_events)
 
+        # the kept events may lack a field entirely, e.g. m_unitTypeName
+        # when there are no core unit events
+        df = df.reindex(columns=df.columns.union(DURATION_COLUMNS, sort=False))
+
         # get gameloop where match match starts
         start_gameloop = df.query(
             'm_eventName == b"GatesOpen"').iloc[0]['_gameloop']
@@ -93,7 +478,7 @@ class Replay(object):
         died_core_df = cores_df.merge(units_died_df, on='m_unitTagIndex')
 
         if len(died_core_df) == 0:
-            final_gameloop = units_died_df.iloc[-1]['_gameloop']
+            final_gameloop = self._last_unit_death['_gameloop']
         elif len(died_core_df) == 1:
             final_gameloop = died_core_df.iloc[0]['_gameloop_y']
         else:
@@ -112,6 +497,8 @@ class Replay(object):
         return self.duration / 60
 
     def __get_player_list_df__(self):
+        import pandas as pd
+
         df = pd.DataFrame(self._details['m_playerList'])
         df['m_name'] = df['m_name'].str.decode('utf-8')
         df['m_hero'] = df['m_hero'].str.decode('utf-8')
@@ -119,6 +506,8 @@ class Replay(object):
         return df
 
     def __get_player_stats_df__(self, player_slot_ids, metrics_list):
+        import pandas as pd
+
         metrics_dict = {'m_workingSetSlotId': player_slot_ids}
 
         for metric_dataset in metrics_list:
@@ -134,6 +523,11 @@ class Replay(object):
         return pd.DataFrame(metrics_dict)
 
     def get_player_info(self):
+        import pandas as pd
+
+        if self._summary is not None:
+            return pd.DataFrame(self._summary['player_info'])
+
         player_list = []
 
         for player in self._details['m_playerList']:
@@ -148,6 +542,11 @@ class Replay(object):
         return pd.DataFrame(player_list)
 
     def get_metrics(self):
+        import pandas as pd
+
+        if self._summary is not None:
+            return pd.DataFrame(self._summary['metrics'])
+
         players_df = self.__get_player_list_df__()
         stats_df = self.__get_player_stats_df__(
             players_df['m_workingSetSlotId'].to_list(),
@@ -178,3 +577,107 @@ class Replay(object):
         metrics_df = metrics_df.astype(conversion_dict)
 
         return metrics_df
+
+    def get_metrics_timeline(self):
+        # One row per player and score result event in the tracker stream,
+        # the last one being the final score. Replays may only hold the
+        # final score, the timeline then has a single row per player.
+        # Returned as column lists.
+        if self._summary is not None:
+            return self._summary['metrics_timeline']
+
+        players = [(player['m_workingSetSlotId'], player['m_toon']['m_id'])
+                   for player in self._details['m_playerList']]
+
+        timeline = {'blizzard_id': [], 'gameloop': []}
+        timeline.update({column: [] for column in TIMELINE_METRICS.values()})
+
+        for event in self._tracker_events:
+            if event['_event'] != SCORE_RESULT_EVENT:
+                continue
+
+            snapshot = {
+                TIMELINE_METRICS[metric_dataset['m_name']]:
+                metric_dataset['m_values']
+                for metric_dataset in event['m_instanceList']
+                if metric_dataset['m_name'] in TIMELINE_METRICS
+            }
+
+            for slot_id, blizzard_id in players:
+                timeline['blizzard_id'].append(blizzard_id)
+                timeline['gameloop'].append(event['_gameloop'])
+
+            for column in TIMELINE_METRICS.values():
+                metric_values = snapshot.get(column)
+
+                timeline[column].extend(
+                    None if metric_values is None else
+                    metric_values[slot_id][0]['m_value']
+                    for slot_id, _ in players)
+
+        return timeline
+
+    def get_summary(self):
+        with metrics.timer('metrics'):
+            metrics_df = self.get_metrics()
+            player_info_df = self.get_player_info()
+            metrics_timeline = self.get_metrics_timeline()
+
+        return {
+            'header': self._header,
+            'details': self._details,
+            'map_name': self.map_name,
+            'utc_time': self.utc_time,
+            'duration': self.duration,
+            'metrics': metrics_df.to_dict(orient='list'),
+            'player_info': player_info_df.to_dict(orient='list'),
+            'metrics_timeline': metrics_timeline
+        }
+
+    def get_slim_summary(self):
+        # picklable stand-in for DB.add_replay without header and details
+        summary = self.get_summary()
+
+        return ReplaySummary(summary=summary,
+                             league=self.league,
+                             season=self.season,
+                             match_id=self.match_id,
+                             round_id=self.round_id,
+                             fingerprint=self.fingerprint)
+
+
+class ReplaySummary(object):
+    def __init__(self, summary, league=None, season=None, match_id=None,
+                 round_id=None, fingerprint=None):
+        self.league = league
+        self.season = season
+        self.match_id = match_id
+        self.round_id = round_id
+        self.fingerprint = fingerprint
+
+        self.map_name = summary['map_name']
+        self.utc_time = summary['utc_time']
+        self.duration = summary['duration']
+
+        self._metrics = summary['metrics']
+        self._player_info = summary['player_info']
+        self._metrics_timeline = summary['metrics_timeline']
+
+    def get_duration_secs(self):
+        return self.duration
+
+    def get_duration_mins(self):
+        return self.duration / 60
+
+    def get_player_info(self):
+        import pandas as pd
+
+        return pd.DataFrame(self._player_info)
+
+    def get_metrics(self):
+        import pandas as pd
+
+        return pd.DataFrame(self._metrics)
+
+    def get_metrics_timeline(self):
+        return self._metrics_timeline
@@ -0,0 +1,206 @@
+import os
+import csv
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from src.protocols import warm_protocols
+from src.replay import ReplayParser, get_utc_time
+
+INDEX_COLUMNS = ('file_name', 'size', 'base_build', 'build', 'map_name',
+                 'utc_time', 'elapsed_gameloops', 'toons', 'identity',
+                 'match_id', 'round_id', 'error')
+
+# toon handles in the index are joined by this
+TOON_SEPARATOR = ';'
+
+
+def get_toon_handle(toon):
+    # region-program-realm-id, e.g. 2-Hero-1-123456
+    return f"{toon['m_region']}-{toon['m_programId'].decode('utf-8')}-" \
+        f"{toon['m_realm']}-{toon['m_id']}"
+
+
+def get_replay_identity(header, details):
+    # Same for every copy of a game, whatever the file name or container.
+    # Built from the header and details only, so it is known without
+    # decoding any events. Ingestion skips copies by the replay
+    # fingerprint instead, the digest of the file bytes.
+    identity = hashlib.sha256()
+
+    for value in (header['m_version']['m_baseBuild'],
+                  header['m_elapsedGameLoops'], details['m_timeUTC'],
+                  details['m_title'].decode('utf-8'), *[
+                      get_toon_handle(player['m_toon'])
+                      for player in details['m_playerList']
+                  ]):
+        identity.update(f'{value}\n'.encode('utf-8'))
+
+    return identity.hexdigest()
+
+
+def get_file_info(file_name):
+    # match and round from the file name, None if it doesn't follow the
+    # ReplayFile naming
+    from src.workers import ReplayFile
+
+    try:
+        replay_file = ReplayFile(file_name=file_name)
+    except (IndexError, ValueError):
+        return None, None
+
+    return replay_file.match_id, replay_file.round_id
+
+
+def scan_replay(replay_path):
+    # reads the header and replay.details, never the event streams
+    with ReplayParser(replay_path=replay_path) as replay:
+        header = replay.header
+        details = replay.get_details()
+
+    file_name = os.path.basename(replay_path)
+    match_id, round_id = get_file_info(file_name)
+
+    return {
+        'file_name': file_name,
+        'size': os.path.getsize(replay_path),
+        'base_build': header['m_version']['m_baseBuild'],
+        'build': header['m_version']['m_build'],
+        'map_name': details['m_title'].decode('utf-8'),
+        'utc_time': get_utc_time(details),
+        'elapsed_gameloops': header['m_elapsedGameLoops'],
+        'toons': [
+            get_toon_handle(player['m_toon'])
+            for player in details['m_playerList']
+        ],
+        'identity': get_replay_identity(header, details),
+        'match_id': match_id,
+        'round_id': round_id,
+        'error': None
+    }
+
+
+def _scan_replay_entry(replay_path):
+    # broken files end up in the index instead of failing the scan
+    try:
+        return scan_replay(replay_path)
+    except Exception as e:
+        entry = {column: None for column in INDEX_COLUMNS}
+        entry['file_name'] = os.path.basename(replay_path)
+        entry['error'] = repr(e)
+
+        return entry
+
+
+def get_replay_paths(directory):
+    return sorted(
+        os.path.join(directory, file_name)
+        for file_name in os.listdir(directory)
+        if file_name.endswith('.StormReplay'))
+
+
+def scan_directory(directory,
+                   n_workers=None,
+                   protocol_builds=None,
+                   chunk_size=64):
+    # One index entry per replay, sorted by file name. None uses all
+    # cores, 0 scans in the calling process. Replays are cheap to scan, so
+    # they are sent to the workers in chunks.
+    replay_paths = get_replay_paths(directory)
+    warm_protocols(protocol_builds)
+
+    if n_workers == 0 or len(replay_paths) <= 1:
+        return [_scan_replay_entry(path) for path in replay_paths]
+
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             initializer=warm_protocols,
+                             initargs=(protocol_builds, )) as executor:
+        return list(
+            executor.map(_scan_replay_entry,
+                         replay_paths,
+                         chunksize=chunk_size))
+
+
+def get_duplicates(entries):
+    # identity -> file names of the replays stored more than once
+    file_names = {}
+
+    for entry in entries:
+        if entry['identity'] is not None:
+            file_names.setdefault(entry['identity'],
+                                  []).append(entry['file_name'])
+
+    return {
+        identity: names
+        for identity, names in file_names.items() if len(names) > 1
+    }
+
+
+def write_index(entries, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=INDEX_COLUMNS)
+        writer.writeheader()
+
+        for entry in entries:
+            toons = entry['toons']
+            writer.writerow({
+                **entry, 'toons':
+                None if toons is None else TOON_SEPARATOR.join(toons)
+            })
+
+
+def read_index(path):
+    entries = []
+
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            entry = {
+                column: None if value == '' else value
+                for column, value in row.items()
+            }
+
+            for column in ('size', 'base_build', 'build', 'utc_time',
+                           'elapsed_gameloops', 'match_id', 'round_id'):
+                if entry[column] is not None:
+                    entry[column] = int(entry[column])
+
+            if entry['toons'] is not None:
+                entry['toons'] = entry['toons'].split(TOON_SEPARATOR)
+
+            entries.append(entry)
+
+    return entries
+
+
+def get_index_df(entries):
+    # indexed by file name, e.g. to join the watchdog state against
+    import pandas as pd
+
+    return pd.DataFrame(entries, columns=INDEX_COLUMNS).set_index('file_name')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Index a replay directory from the replay headers.')
+    parser.add_argument('directory')
+    parser.add_argument('index_path', help='csv file the index is written to')
+    parser.add_argument('--n-workers', type=int)
+    parser.add_argument('--protocol-builds', type=int, nargs='*')
+    args = parser.parse_args(args)
+
+    entries = scan_directory(args.directory,
+                             n_workers=args.n_workers,
+                             protocol_builds=args.protocol_builds)
+    write_index(entries, args.index_path)
+
+    n_failed = sum(entry['error'] is not None for entry in entries)
+    duplicates = get_duplicates(entries)
+
+    print(f'Scanned {len(entries)} replays, {n_failed} failed, '
+          f'{len(duplicates)} stored more than once.')
+
+    for names in duplicates.values():
+        print(', '.join(names))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+import os
+import signal
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from src.metrics import metrics
+from src.protocols import warm_protocols
+from src.workers import (DataBaseUpdater, ReplayDirectoryWatchDog,
+                         _init_parse_worker, parse_replay_job)
+
+EXECUTORS = ('process', 'thread')
+
+# ends the parser and writer coroutines once the queues are drained
+_DONE = object()
+
+
+class IngestService(DataBaseUpdater):
+    # Watcher -> bounded parse queue -> parsers in an executor -> bounded
+    # write queue -> one DB writer committing in batches. Full queues
+    # block the stage in front of them, so bursts don't pile up in memory.
+    def __init__(self,
+                 watch_dog,
+                 db_path,
+                 executor='process',
+                 queue_size=64,
+                 batch_size=32,
+                 batch_timeout=1.0,
+                 poll_interval=1.0,
+                 **kwargs):
+        super().__init__(watch_dog=watch_dog, db_path=db_path, **kwargs)
+
+        if executor not in EXECUTORS:
+            raise Exception(
+                f'Unknown executor {executor}. Choose one of {EXECUTORS}.')
+
+        self._executor_type = executor
+        self._queue_size = queue_size
+        self._batch_size = batch_size
+        self._batch_timeout = batch_timeout
+        self._poll_interval = poll_interval
+
+        # file names queued or being parsed, not handed out twice
+        self._in_flight = set()
+
+        # file name -> fingerprint that failed, retried once it changes
+        self._failed_fingerprints = {}
+
+        self._stop_event = None
+
+    def __get_executor__(self):
+        n_workers = self._n_workers or os.cpu_count()
+        initargs = (self._cache_dir, metrics.enabled, self._protocol_builds,
+                    self._event_store)
+
+        if self._executor_type == 'thread':
+            return ThreadPoolExecutor(max_workers=n_workers,
+                                      initializer=_init_parse_worker,
+                                      initargs=initargs)
+
+        warm_protocols(self._protocol_builds)
+
+        return ProcessPoolExecutor(max_workers=n_workers,
+                                   initializer=_init_parse_worker,
+                                   initargs=initargs)
+
+    def __get_new_jobs__(self):
+        jobs = []
+
+        for file_name, args in self.__get_parse_jobs__():
+            if file_name in self._in_flight:
+                continue
+
+            fingerprint = self._watchdog.dir_content[file_name].fingerprint
+            if self._failed_fingerprints.get(file_name) == fingerprint:
+                continue
+
+            self._in_flight.add(file_name)
+            jobs.append((file_name, args))
+
+        return jobs
+
+    def __finish_job__(self, file_name):
+        self._in_flight.discard(file_name)
+
+        file = self._watchdog.dir_content.get(file_name)
+        if file_name in self.failed_files and file is not None:
+            self._failed_fingerprints[file_name] = file.fingerprint
+        else:
+            self._failed_fingerprints.pop(file_name, None)
+
+    def __fail_job__(self, file_name, error):
+        self.__fail__(file_name, error)
+        self.__finish_job__(file_name)
+
+    def __write_batch__(self, batch):
+        # batch: list of (file name, summary, metrics record)
+        try:
+            with metrics.timer('db_write_batch'):
+                self._db.add_replays([summary for _, summary, _ in batch])
+        except Exception:
+            # add_replays rolled back, isolate the broken replays
+            for file_name, summary, record in batch:
+                try:
+                    self.__write_summary__(file_name, summary, record)
+                except Exception as e:
+                    # e.g. the watchdog state could not be saved
+                    self.failed_files[file_name] = e
+                    metrics.end_replay(error=e)
+
+                self.__finish_job__(file_name)
+            return
+
+        # one failing file must not stop the writer
+        for file_name, _, record in batch:
+            metrics.begin_replay(file_name, record=record)
+
+            try:
+                self._watchdog.mark_processed(file_name)
+            except Exception as e:
+                self.failed_files[file_name] = e
+                metrics.end_replay(error=e)
+            else:
+                self.failed_files.pop(file_name, None)
+                metrics.end_replay()
+
+            self.__finish_job__(file_name)
+
+    async def __wait_for_changes__(self, loop):
+        fd = self._watchdog.fileno()
+
+        if fd is None:
+            await asyncio.sleep(self._poll_interval)
+            return
+
+        # wake up as soon as inotify has events, poll as a fallback
+        changed = asyncio.Event()
+        loop.add_reader(fd, changed.set)
+
+        try:
+            await asyncio.wait_for(changed.wait(), self._poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(fd)
+
+    async def __watch__(self, loop, state_executor, parse_queue, n_parsers):
+        try:
+            while not self._stop_event.is_set():
+                # the watchdog is only touched from the state executor
+                await loop.run_in_executor(state_executor,
+                                           self._watchdog.update)
+                jobs = await loop.run_in_executor(state_executor,
+                                                  self.__get_new_jobs__)
+
+                for job in jobs:
+                    await parse_queue.put(job)
+
+                if len(jobs) == 0:
+                    await self.__wait_for_changes__(loop)
+        finally:
+            for _ in range(n_parsers):
+                await parse_queue.put(_DONE)
+
+    async def __parse__(self, loop, executor, parse_queue, write_queue):
+        while True:
+            job = await parse_queue.get()
+
+            if job is _DONE:
+                await write_queue.put(_DONE)
+                return
+
+            file_name, args = job
+
+            try:
+                summary, record = await loop.run_in_executor(
+                    executor, parse_replay_job, file_name, args)
+            except Exception as e:
+                await write_queue.put((file_name, e, None))
+                continue
+
+            await write_queue.put((file_name, summary, record))
+
+    async def __write__(self, loop, state_executor, write_queue, n_parsers):
+        n_done = 0
+        batch = []
+        deadline = None
+
+        while n_done < n_parsers:
+            timeout = None if deadline is None \
+                else max(deadline - loop.time(), 0)
+
+            try:
+                item = await asyncio.wait_for(write_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                item = None
+
+            if item is _DONE:
+                n_done += 1
+            elif item is not None:
+                file_name, summary, _ = item
+
+                if isinstance(summary, Exception):
+                    await loop.run_in_executor(state_executor,
+                                               self.__fail_job__, file_name,
+                                               summary)
+                else:
+                    batch.append(item)
+                    if deadline is None:
+                        deadline = loop.time() + self._batch_timeout
+
+            flush = len(batch) >= self._batch_size or \
+                (deadline is not None and loop.time() >= deadline) or \
+                n_done == n_parsers
+
+            if flush and len(batch) > 0:
+                await loop.run_in_executor(state_executor,
+                                           self.__write_batch__, batch)
+
+                batch = []
+                deadline = None
+
+    async def run(self):
+        # runs until stop() is called, then drains the queues
+        loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+
+        parse_queue = asyncio.Queue(maxsize=self._queue_size)
+        write_queue = asyncio.Queue(maxsize=self._queue_size)
+        n_parsers = self._n_workers or os.cpu_count()
+
+        with self.__get_executor__() as executor, \
+                ThreadPoolExecutor(max_workers=1) as state_executor:
+            await asyncio.gather(
+                self.__watch__(loop, state_executor, parse_queue, n_parsers),
+                *[
+                    self.__parse__(loop, executor, parse_queue, write_queue)
+                    for _ in range(n_parsers)
+                ],
+                self.__write__(loop, state_executor, write_queue, n_parsers))
+
+    def stop(self):
+        # call from the event loop, e.g. loop.call_soon_threadsafe(stop)
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+    def serve(self):
+        # blocking entry point, SIGINT and SIGTERM drain and exit
+        async def main():
+            loop = asyncio.get_running_loop()
+
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, self.stop)
+
+            await self.run()
+
+        asyncio.run(main())
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Ingest replays into the DB as they land.')
+    parser.add_argument('working_dir', help='directory the replays land in')
+    parser.add_argument('config_dir', help='directory of the watchdog state')
+    parser.add_argument('db_path')
+    parser.add_argument('--league')
+    parser.add_argument('--season', type=int)
+    parser.add_argument('--executor', choices=EXECUTORS, default='process')
+    parser.add_argument('--n-workers', type=int)
+    parser.add_argument('--cache-dir')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--batch-timeout', type=float, default=1.0)
+    parser.add_argument('--concurrent',
+                        action='store_true',
+                        help='WAL mode, readers are not blocked by the '
+                        'ingest commits')
+    args = parser.parse_args(args)
+
+    watch_dog = ReplayDirectoryWatchDog(working_dir=args.working_dir,
+                                        config_dir=args.config_dir)
+
+    service = IngestService(watch_dog=watch_dog,
+                            db_path=args.db_path,
+                            executor=args.executor,
+                            batch_size=args.batch_size,
+                            batch_timeout=args.batch_timeout,
+                            league=args.league,
+                            season=args.season,
+                            n_workers=args.n_workers,
+                            cache_dir=args.cache_dir,
+                            db_concurrent=args.concurrent)
+
+    try:
+        service.serve()
+    finally:
+        watch_dog.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,484 @@
+import os
+import random
+import struct
+import mpyq
+from src.protocols import get_latest_build, get_protocol
+from src.replay import (GATES_OPEN_EVENT, CORE_UNIT_NAMES, STAT_GAME_EVENT,
+                        UNIT_BORN_EVENT, UNIT_DIED_EVENT, SCORE_RESULT_EVENT)
+
+UNIT_POSITIONS_EVENT = 'NNet.Replay.Tracker.SUnitPositionsEvent'
+
+GAMELOOPS_PER_SECOND = 16
+SCORE_METRICS = (b'SoloKill', b'Deaths', b'Assists', b'ExperienceContribution',
+                 b'Healing', b'DamageSoaked', b'SiegeDamage', b'HeroDamage',
+                 b'TimeSpentDead', b'TownKills')
+MAP_NAMES = (b'Cursed Hollow', b'Dragon Shire', b'Sky Temple',
+             b'Battlefield of Eternity', b'Towers of Doom', b'Infernal Shrines')
+HERO_NAMES = (b'Muradin', b'Jaina', b'Uther', b'Valla', b'Johanna', b'Li Li',
+              b'Raynor', b'Diablo', b'Malfurion', b'Zeratul', b'Tyrande',
+              b'Arthas')
+
+MPQ_FILE_EXISTS = 0x80000000
+MPQ_FILE_SINGLE_UNIT = 0x01000000
+MPQ_HEADER_OFFSET = 0x400
+
+
+class VersionedEncoder(object):
+    # inverse of heroprotocol's VersionedDecoder, missing fields are encoded
+    # with their type's zero value
+    def __init__(self, typeinfos):
+        self._typeinfos = typeinfos
+        self._buffer = bytearray()
+
+    def get_bytes(self):
+        return bytes(self._buffer)
+
+    def instance(self, typeid, value):
+        typeinfo = self._typeinfos[typeid]
+        getattr(self, typeinfo[0])(value, *typeinfo[1])
+
+    def _vint(self, value):
+        negative = value < 0
+        value = abs(value)
+
+        byte = ((value & 0x3F) << 1) | negative
+        value >>= 6
+
+        while value:
+            self._buffer.append(byte | 0x80)
+            byte = value & 0x7F
+            value >>= 7
+
+        self._buffer.append(byte)
+
+    def _array(self, value, bounds, typeid):
+        value = value or []
+
+        self._buffer.append(0)
+        self._vint(len(value))
+
+        for item in value:
+            self.instance(typeid, item)
+
+    def _bitarray(self, value, bounds):
+        length, data = value or (0, b'')
+
+        self._buffer.append(1)
+        self._vint(length)
+        self._buffer += data
+
+    def _blob(self, value, bounds):
+        value = value or b''
+
+        self._buffer.append(2)
+        self._vint(len(value))
+        self._buffer += value
+
+    def _bool(self, value):
+        self._buffer.append(6)
+        self._buffer.append(1 if value else 0)
+
+    def _choice(self, value, bounds, fields):
+        tag, (name, typeid) = next(iter(fields.items()))
+        if value:
+            name = next(iter(value))
+            tag, (_, typeid) = next(
+                (tag, field) for tag, field in fields.items()
+                if field[0] == name)
+
+        self._buffer.append(3)
+        self._vint(tag)
+        self.instance(typeid, (value or {}).get(name))
+
+    def _fourcc(self, value):
+        self._buffer.append(7)
+        self._buffer += (value or b'').ljust(4, b'\0')[:4]
+
+    def _int(self, value, bounds):
+        self._buffer.append(9)
+        self._vint(value or 0)
+
+    def _null(self, value):
+        pass
+
+    def _optional(self, value, typeid):
+        self._buffer.append(4)
+        self._buffer.append(0 if value is None else 1)
+
+        if value is not None:
+            self.instance(typeid, value)
+
+    def _real32(self, value):
+        self._buffer.append(7)
+        self._buffer += struct.pack('>f', value[0] if value else 0.0)
+
+    def _real64(self, value):
+        self._buffer.append(8)
+        self._buffer += struct.pack('>d', value[0] if value else 0.0)
+
+    def _struct(self, value, fields):
+        self._buffer.append(5)
+        self._vint(len(fields))
+
+        for name, typeid, tag in fields:
+            self._vint(tag)
+
+            if name == '__parent':
+                self.instance(typeid, value)
+            else:
+                self.instance(typeid, (value or {}).get(name))
+
+
+def encode_tracker_events(protocol, events):
+    encoder = VersionedEncoder(protocol.typeinfos)
+    event_ids = {
+        name: (eventid, typeid)
+        for eventid, (typeid, name) in protocol.tracker_event_types.items()
+    }
+
+    gameloop = 0
+    for event in events:
+        delta = event['_gameloop'] - gameloop
+        gameloop = event['_gameloop']
+
+        if delta < 1 << 6:
+            delta = {'m_uint6': delta}
+        elif delta < 1 << 14:
+            delta = {'m_uint14': delta}
+        elif delta < 1 << 22:
+            delta = {'m_uint22': delta}
+        else:
+            delta = {'m_uint32': delta}
+        encoder.instance(protocol.svaruint32_typeid, delta)
+
+        eventid, typeid = event_ids[event['_event']]
+        encoder.instance(protocol.tracker_eventid_typeid, eventid)
+        encoder.instance(typeid, event)
+
+    return encoder.get_bytes()
+
+
+def _encrypt(archive, data, key):
+    # inverse of MPQArchive._decrypt
+    seed1 = key
+    seed2 = 0xEEEEEEEE
+    result = bytearray()
+
+    for i in range(len(data) // 4):
+        seed2 += archive.encryption_table[0x400 + (seed1 & 0xFF)]
+        seed2 &= 0xFFFFFFFF
+
+        value = struct.unpack('<I', data[i * 4:i * 4 + 4])[0]
+        result += struct.pack('<I', (value ^ (seed1 + seed2)) & 0xFFFFFFFF)
+
+        seed1 = ((~seed1 << 0x15) + 0x11111111) | (seed1 >> 0x0B)
+        seed1 &= 0xFFFFFFFF
+        seed2 = value + seed2 + (seed2 << 5) + 3 & 0xFFFFFFFF
+
+    return bytes(result)
+
+
+def write_mpq_archive(files, user_data):
+    # uncompressed single unit files, readable by mpyq
+    archive = mpyq.MPQArchive.__new__(mpyq.MPQArchive)
+    files = dict(files)
+    files['(listfile)'] = '\r\n'.join(files.keys()).encode('utf-8')
+
+    hash_entries = 1
+    while hash_entries < len(files):
+        hash_entries *= 2
+
+    data = bytearray()
+    hash_table = [(0xFFFFFFFF, 0xFFFFFFFF, 0xFFFF, 0xFFFF, 0xFFFFFFFF)
+                  ] * hash_entries
+    block_table = []
+    header_size = struct.calcsize(mpyq.MPQFileHeader.struct_format)
+
+    for i, (name, content) in enumerate(files.items()):
+        hash_table[i] = (archive._hash(name, 'HASH_A'),
+                         archive._hash(name, 'HASH_B'), 0, 0, i)
+        block_table.append((header_size + len(data), len(content),
+                            len(content),
+                            MPQ_FILE_EXISTS | MPQ_FILE_SINGLE_UNIT))
+        data += content
+
+    hash_table = b''.join(
+        struct.pack('<' + mpyq.MPQHashTableEntry.struct_format, *entry)
+        for entry in hash_table)
+    block_table = b''.join(
+        struct.pack('<' + mpyq.MPQBlockTableEntry.struct_format, *entry)
+        for entry in block_table)
+
+    hash_table_offset = header_size + len(data)
+    block_table_offset = hash_table_offset + len(hash_table)
+    archive_size = block_table_offset + len(block_table)
+
+    mpq_header = struct.pack(mpyq.MPQFileHeader.struct_format, b'MPQ\x1a',
+                             header_size, archive_size, 0, 3,
+                             hash_table_offset, block_table_offset,
+                             hash_entries, len(files))
+
+    user_data_header = struct.pack(mpyq.MPQUserDataHeader.struct_format,
+                                   b'MPQ\x1b', 0x200, MPQ_HEADER_OFFSET,
+                                   len(user_data))
+    user_data_header = (user_data_header + user_data).ljust(
+        MPQ_HEADER_OFFSET, b'\0')
+
+    return b''.join([
+        user_data_header, mpq_header,
+        bytes(data),
+        _encrypt(archive, hash_table,
+                 archive._hash('(hash table)', 'TABLE')),
+        _encrypt(archive, block_table,
+                 archive._hash('(block table)', 'TABLE'))
+    ])
+
+
+def _get_unit_event(name, gameloop, tag_index, **kwargs):
+    return {
+        '_event': name,
+        '_gameloop': gameloop,
+        'm_unitTagIndex': tag_index,
+        'm_unitTagRecycle': 1,
+        **kwargs
+    }
+
+
+def _get_score_event(rng, gameloop, totals):
+    # score values only grow over the game
+    for values in totals.values():
+        for slot_id in range(len(values)):
+            values[slot_id] += rng.randint(0, 100)
+
+    return {
+        '_event':
+        SCORE_RESULT_EVENT,
+        '_gameloop':
+        gameloop,
+        'm_instanceList': [{
+            'm_name': metric,
+            'm_values': [[{
+                'm_value': value,
+                'm_time': 0
+            }] for value in values]
+        } for metric, values in totals.items()]
+    }
+
+
+def generate_tracker_events(rng,
+                            n_events=20000,
+                            game_length=20 * 60,
+                            score_interval=0,
+                            n_cores=2,
+                            n_core_deaths=1):
+    # score_interval: events between periodic score snapshots. 0, the
+    # default, emits the final score only like the replays seen so far.
+    # The last n_core_deaths of the n_cores cores die at
+    # the end of the game.
+    gates_open = 45 * GAMELOOPS_PER_SECOND
+    max_delta = max(1, 2 * game_length * GAMELOOPS_PER_SECOND // n_events)
+    events = [
+        _get_unit_event(UNIT_BORN_EVENT,
+                        0,
+                        tag_index,
+                        m_unitTypeName=core_name,
+                        m_controlPlayerId=11 + tag_index,
+                        m_upkeepPlayerId=11 + tag_index,
+                        m_x=20 + 200 * tag_index,
+                        m_y=120)
+        for tag_index, core_name in enumerate(CORE_UNIT_NAMES[:n_cores])
+    ]
+    events.append({
+        '_event': STAT_GAME_EVENT,
+        '_gameloop': gates_open,
+        'm_eventName': GATES_OPEN_EVENT
+    })
+
+    gameloop = gates_open
+    alive = []
+    next_tag = len(events)
+    totals = {metric: [0] * 16 for metric in SCORE_METRICS}
+
+    for i in range(n_events):
+        gameloop += rng.randint(0, max_delta)
+
+        if score_interval > 0 and i % score_interval == score_interval - 1:
+            events.append(_get_score_event(rng, gameloop, totals))
+        elif i % 500 == 0:
+            events.append({
+                '_event': UNIT_POSITIONS_EVENT,
+                '_gameloop': gameloop,
+                'm_firstUnitIndex': next_tag,
+                'm_items': [rng.randint(0, 255) for _ in range(30)]
+            })
+        elif i % 250 == 0:
+            events.append({
+                '_event': STAT_GAME_EVENT,
+                '_gameloop': gameloop,
+                'm_eventName': b'PeriodicXPBreakdown',
+                'm_intData': [{
+                    'm_key': b'Team',
+                    'm_value': team
+                } for team in (1, 2)],
+                'm_fixedData': [{
+                    'm_key': b'MinionXP',
+                    'm_value': rng.randint(0, 1 << 20)
+                }]
+            })
+        elif len(alive) > 0 and rng.random() < 0.5:
+            tag_index = alive.pop(rng.randrange(len(alive)))
+            events.append(
+                _get_unit_event(UNIT_DIED_EVENT,
+                                gameloop,
+                                tag_index,
+                                m_killerPlayerId=rng.randint(1, 10),
+                                m_x=rng.randint(0, 250),
+                                m_y=rng.randint(0, 250)))
+        else:
+            alive.append(next_tag)
+            events.append(
+                _get_unit_event(UNIT_BORN_EVENT,
+                                gameloop,
+                                next_tag,
+                                m_unitTypeName=b'FootmanMinion',
+                                m_controlPlayerId=11 + rng.randint(0, 1),
+                                m_upkeepPlayerId=11,
+                                m_x=rng.randint(0, 250),
+                                m_y=rng.randint(0, 250)))
+            next_tag += 1
+
+    for tag_index in range(n_cores - 1, n_cores - 1 - n_core_deaths, -1):
+        gameloop += GAMELOOPS_PER_SECOND
+        events.append(
+            _get_unit_event(UNIT_DIED_EVENT,
+                            gameloop,
+                            tag_index,
+                            m_killerPlayerId=rng.randint(1, 5),
+                            m_x=20 + 200 * tag_index,
+                            m_y=120))
+
+    events.append(_get_score_event(rng, gameloop + 1, totals))
+
+    return events
+
+
+def generate_details(rng, player_pool=200, utc_time=None):
+    if utc_time is None:
+        utc_time = rng.randint(1577836800, 1609459200)
+
+    toon_ids = rng.sample(range(1, player_pool + 1), 10)
+    player_list = [{
+        'm_name': f'Player{toon_id}'.encode('utf-8'),
+        'm_toon': {
+            'm_region': 2,
+            'm_programId': b'Hero',
+            'm_realm': 1,
+            'm_id': toon_id
+        },
+        'm_control': 2,
+        'm_teamId': slot_id // 5,
+        'm_handicap': 100,
+        'm_result': 1 if slot_id < 5 else 2,
+        'm_workingSetSlotId': slot_id,
+        'm_hero': rng.choice(HERO_NAMES)
+    } for slot_id, toon_id in enumerate(toon_ids)]
+
+    # Windows file time in 100ns steps since 1601
+    return {
+        'm_playerList': player_list,
+        'm_title': rng.choice(MAP_NAMES),
+        'm_timeUTC': (utc_time + 11644473600) * 10**7,
+        'm_timeLocalOffset': 0
+    }
+
+
+def generate_header(base_build, elapsed_gameloops):
+    return {
+        'm_signature': b'Heroes of the Storm replay\x1b11',
+        'm_version': {
+            'm_flags': 1,
+            'm_major': 2,
+            'm_minor': 55,
+            'm_revision': 0,
+            'm_build': base_build,
+            'm_baseBuild': base_build
+        },
+        'm_type': 2,
+        'm_elapsedGameLoops': elapsed_gameloops,
+        'm_useScaledTime': False,
+        'm_dataBuildNum': base_build
+    }
+
+
+def generate_decoded_replay(seed=0,
+                            n_events=20000,
+                            game_length=20 * 60,
+                            score_interval=0,
+                            n_cores=2,
+                            n_core_deaths=1):
+    rng = random.Random(seed)
+
+    tracker_events = generate_tracker_events(rng,
+                                             n_events=n_events,
+                                             game_length=game_length,
+                                             score_interval=score_interval,
+                                             n_cores=n_cores,
+                                             n_core_deaths=n_core_deaths)
+    details = generate_details(rng)
+
+    header = generate_header(base_build=get_latest_build(),
+                             elapsed_gameloops=tracker_events[-1]['_gameloop'])
+
+    return {
+        'header': header,
+        'details': details,
+        'tracker_events': tracker_events
+    }
+
+
+def encode_replay(decoded_replay):
+    protocol = get_protocol(
+        decoded_replay['header']['m_version']['m_baseBuild'])
+
+    header = VersionedEncoder(protocol.typeinfos)
+    header.instance(protocol.replay_header_typeid, decoded_replay['header'])
+
+    details = VersionedEncoder(protocol.typeinfos)
+    details.instance(protocol.game_details_typeid, decoded_replay['details'])
+
+    files = {
+        'replay.details':
+        details.get_bytes(),
+        'replay.tracker.events':
+        encode_tracker_events(protocol, decoded_replay['tracker_events'])
+    }
+
+    return write_mpq_archive(files=files, user_data=header.get_bytes())
+
+
+def write_replays(directory,
+                  n_replays,
+                  league='Synthetic',
+                  season=1,
+                  rounds_per_match=3,
+                  n_events=20000,
+                  seed=0):
+    # file names follow the pattern ReplayFile parses
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+
+    for i in range(n_replays):
+        match_id = i // rounds_per_match + 1
+        round_id = i % rounds_per_match + 1
+
+        decoded_replay = generate_decoded_replay(seed=seed + i,
+                                                 n_events=n_events)
+        file_name = f'synthetic-{league}-{season}- Match {match_id} Round {round_id} - TeamA vs TeamB .StormReplay'
+        path = os.path.join(directory, file_name)
+
+        with open(path, 'wb') as f:
+            f.write(encode_replay(decoded_replay))
+
+        paths.append(path)
+
+    return paths
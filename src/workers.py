@@ -1,8 +1,95 @@
+import io
 import os
+import csv
 from time import time
-from src.db import DB
-from src.replay import Replay
-from src.evaluation import Match
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from src.cache import ReplayCache
+from src.inotify import INotify
+from src.metrics import metrics
+from src.protocols import warm_protocols
+from src.replay import Replay, get_replay_fingerprint
+
+# per worker process replay cache and (store dir, store format) of the
+# columnar tracker events, see _init_parse_worker
+_worker_cache = None
+_worker_event_store = None
+
+
+def _init_parse_worker(cache_dir,
+                       collect_metrics=False,
+                       protocol_builds=None,
+                       event_store=None):
+    global _worker_cache, _worker_event_store
+
+    # no-op for forked workers, the parent warmed the protocols already
+    warm_protocols(protocol_builds)
+
+    if cache_dir is not None:
+        _worker_cache = ReplayCache(cache_dir=cache_dir)
+
+    if collect_metrics:
+        metrics.enable()
+
+    _worker_event_store = event_store
+
+
+def parse_replay(replay_path,
+                 league,
+                 season,
+                 match_id,
+                 round_id,
+                 fingerprint=None):
+    store_path = None
+    if _worker_event_store is not None:
+        from src.events import get_store_path
+
+        store_dir, store_format = _worker_event_store
+        store_path = get_store_path(store_dir,
+                                    os.path.basename(replay_path),
+                                    store_format=store_format)
+
+    # the event store is filled from the same decoding pass
+    replay = Replay(replay_path=replay_path,
+                    league=league,
+                    season=season,
+                    match_id=match_id,
+                    round_id=round_id,
+                    cache=_worker_cache,
+                    fingerprint=fingerprint,
+                    keep_all_events=store_path is not None)
+
+    if store_path is not None:
+        from src.events import TrackerEventStore
+
+        # a cache hit decodes no events, the store of the earlier parse is
+        # kept and only a missing one is decoded
+        with metrics.timer('event_store'):
+            if replay.all_tracker_events is not None:
+                store = TrackerEventStore.from_events(
+                    replay.all_tracker_events)
+                replay.all_tracker_events = None
+            elif not os.path.exists(store_path):
+                store = TrackerEventStore.from_replay(replay_path)
+            else:
+                store = None
+
+            if store is not None:
+                store.save(store_path, store_format=store_format)
+
+    return replay.get_slim_summary()
+
+
+def parse_replay_job(file_name, args):
+    # returns the summary and the metrics record, which is finished by the
+    # process writing the summary to the DB
+    metrics.begin_replay(file_name)
+
+    try:
+        summary = parse_replay(*args)
+    finally:
+        record = metrics.detach_replay()
+
+    return summary, record
 
 
 class File(object):
@@ -11,6 +98,11 @@ class File(object):
         self.processed = False
         self.last_processed = None
 
+        # set by the watchdog from the file system or the saved state
+        self.size = None
+        self.mtime = None
+        self.fingerprint = None
+
     def mark_processed(self):
         self.processed = True
         self.last_processed = time()
@@ -35,50 +127,313 @@ class ReplayFile(File):
         self.teams = [team_1, team_2]
 
 
+class FileStateJournal(object):
+    COLUMNS = ('name', 'size', 'mtime', 'fingerprint', 'processed',
+               'last_processed', 'removed')
+
+    def __init__(self, path, compact_ratio=2):
+        self._path = path
+        self._compact_ratio = compact_ratio
+        self._n_rows = 0
+
+    def load(self):
+        # replays the journal, the last row per file name wins
+        state = {}
+
+        if not os.path.exists(self._path):
+            return state
+
+        with open(self._path, newline='') as f:
+            for row in csv.DictReader(f):
+                self._n_rows += 1
+
+                # a line torn by a crash has missing or cut off fields,
+                # extra fields end up under the None key
+                if None in row or None in row.values() or \
+                        row['name'] == '' or \
+                        row['processed'] not in ('0', '1') or \
+                        row['removed'] not in ('0', '1'):
+                    continue
+
+                removed = row['removed'] == '1'
+                if not removed and row['fingerprint'] == '':
+                    continue
+
+                try:
+                    entry = {
+                        'size': int(row['size']),
+                        'mtime': int(row['mtime']),
+                        'fingerprint': row['fingerprint'],
+                        'processed': row['processed'] == '1',
+                        'last_processed':
+                        float(row['last_processed'])
+                        if row['last_processed'] else None
+                    }
+                except ValueError:
+                    continue
+
+                if removed:
+                    state.pop(row['name'], None)
+                else:
+                    state[row['name']] = entry
+
+        return state
+
+    @staticmethod
+    def __get_row__(file, removed=False):
+        if removed:
+            return [file.name, 0, 0, '', 0, '', 1]
+
+        last_processed = '' if file.last_processed is None \
+            else repr(file.last_processed)
+
+        return [
+            file.name, file.size, file.mtime, file.fingerprint,
+            int(file.processed), last_processed, 0
+        ]
+
+    def append(self, files=(), removed_files=()):
+        rows = [self.__get_row__(file) for file in files]
+        rows += [
+            self.__get_row__(file, removed=True) for file in removed_files
+        ]
+
+        if len(rows) == 0:
+            return
+
+        # a line torn by a crash is ended first, so it is skipped on load
+        # instead of swallowing the first appended row
+        write_header, torn = True, False
+        if os.path.exists(self._path):
+            with open(self._path, 'rb') as f:
+                size = f.seek(0, os.SEEK_END)
+
+                if size > 0:
+                    f.seek(-1, os.SEEK_END)
+                    write_header, torn = False, f.read(1) != b'\n'
+
+        # one write call per batch keeps appends whole
+        lines = io.StringIO()
+        writer = csv.writer(lines)
+
+        if torn:
+            lines.write('\r\n')
+        if write_header:
+            writer.writerow(self.COLUMNS)
+        writer.writerows(rows)
+
+        with open(self._path, 'a', newline='') as f:
+            f.write(lines.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._n_rows += len(rows)
+
+    def needs_compaction(self, n_files):
+        return self._n_rows > self._compact_ratio * max(n_files, 1)
+
+    def compact(self, files):
+        tmp_path = f'{self._path}.tmp'
+
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.COLUMNS)
+            writer.writerows([self.__get_row__(file) for file in files])
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, self._path)
+        self._n_rows = len(files)
+
+
 class DirectoryWatchDog(object):
-    def __init__(self, working_dir, config_dir):
+    def __init__(self, working_dir, config_dir, use_inotify=True):
         self._working_dir = working_dir
         self._last_state_file = os.path.join(config_dir, 'files.csv')
 
+        # restore the state of the last run
+        os.makedirs(config_dir, exist_ok=True)
+        self._state_journal = FileStateJournal(path=self._last_state_file)
+        self._last_state = self._state_journal.load()
+
+        # watch before the first scan so no file slips through in between
+        self._inotify = None
+        if use_inotify and INotify.is_supported():
+            try:
+                self._inotify = INotify(path=self._working_dir)
+            except OSError:
+                self._inotify = None
+
         self.dir_content = {}
-        self.update()
+        self.__rescan__()
 
-    def update(self):
-        current_state = os.listdir(self._working_dir)
-        previous_state = list(self.dir_content.keys())
+        # only needed to resume the files found at startup
+        self._last_state = {}
 
-        added_files = [
-            file_name for file_name in current_state
-            if file_name not in previous_state
-        ]
+    def __rescan__(self):
+        # the files of a deleted or moved away directory are kept until it
+        # exists again
+        try:
+            with os.scandir(self._working_dir) as entries:
+                current_state = {
+                    entry.name
+                    for entry in entries if entry.is_file()
+                }
+        except FileNotFoundError:
+            return
 
-        removed_files = [
-            file_name for file_name in previous_state
-            if file_name not in current_state
-        ]
+        previous_state = set(self.dir_content.keys())
 
+        self.__apply_changes__(added_files=current_state - previous_state,
+                               removed_files=previous_state - current_state)
+
+    def __apply_changes__(self, added_files, removed_files):
         if len(added_files) > 0:
-            self.add_files(file_names=added_files)
+            self.add_files(file_names=sorted(added_files))
 
         if len(removed_files) > 0:
-            self.remove_files(file_names=removed_files)
+            self.remove_files(file_names=sorted(removed_files))
+
+        self.__compact_state__()
+
+    def __has_changed__(self, file_name):
+        file = self.dir_content[file_name]
+
+        try:
+            stat = os.stat(self.get_path(file_name))
+        except FileNotFoundError:
+            return False
+
+        return file.size != stat.st_size or file.mtime != stat.st_mtime_ns
+
+    def __restore_state__(self, file):
+        # returns (exists, changed since the last run)
+        try:
+            stat = os.stat(self.get_path(file.name))
+        except FileNotFoundError:
+            return False, False
+
+        file.size = stat.st_size
+        file.mtime = stat.st_mtime_ns
+
+        last_state = self._last_state.get(file.name)
+
+        # unchanged since the last run, no need to read the content
+        if last_state is not None and last_state['size'] == file.size \
+                and last_state['mtime'] == file.mtime:
+            file.fingerprint = last_state['fingerprint']
+            file.processed = last_state['processed']
+            file.last_processed = last_state['last_processed']
+
+            return True, False
+
+        try:
+            file.fingerprint = get_replay_fingerprint(
+                self.get_path(file.name))
+        except FileNotFoundError:
+            return False, False
+
+        # touched or copied but same content
+        if last_state is not None and \
+                last_state['fingerprint'] == file.fingerprint:
+            file.processed = last_state['processed']
+            file.last_processed = last_state['last_processed']
+
+        return True, True
+
+    def __compact_state__(self):
+        if self._state_journal.needs_compaction(len(self.dir_content)):
+            self._state_journal.compact(files=self.dir_content.values())
+
+    def update(self):
+        if self._inotify is None:
+            self.__rescan__()
+            return
+
+        changes, rescan = self._inotify.read_changes()
+
+        # the kernel queue overflowed or the directory itself changed, it
+        # is polled until it exists again
+        if rescan or not self._inotify.is_watching():
+            self.__rescan__()
+            return
+
+        # rewritten files are examined again
+        added_files = {
+            file_name
+            for file_name, exists in changes.items()
+            if exists and (file_name not in self.dir_content
+                           or self.__has_changed__(file_name))
+        }
+        removed_files = {
+            file_name
+            for file_name, exists in changes.items()
+            if not exists and file_name in self.dir_content
+        }
+
+        self.__apply_changes__(added_files=added_files,
+                               removed_files=removed_files)
+
+    def fileno(self):
+        # None when polling, see update
+        if self._inotify is None or not self._inotify.is_watching():
+            return None
+
+        return self._inotify.fileno()
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
 
     def add_file(self, file_name):
         self.dir_content[file_name] = File(file_name=file_name)
 
     def add_files(self, file_names):
+        added_files = []
+
         for file_name in file_names:
             self.add_file(file_name=file_name)
 
+            file = self.dir_content[file_name]
+            exists, changed = self.__restore_state__(file)
+
+            if not exists:
+                del self.dir_content[file_name]
+            elif changed:
+                added_files.append(file)
+
+        self._state_journal.append(files=added_files)
+
     def remove_file(self, file_name):
         del self.dir_content[file_name]
 
     def remove_files(self, file_names):
+        removed_files = [self.dir_content[file_name] for file_name in file_names]
+
         for file_name in file_names:
             self.remove_file(file_name=file_name)
 
+        self._state_journal.append(removed_files=removed_files)
+
     def mark_processed(self, file_name):
-        self.dir_content[file_name].mark_processed()
+        # the file may have been deleted or moved while it was processed
+        file = self.dir_content.get(file_name)
+        if file is None:
+            return
+
+        file.mark_processed()
+
+        self._state_journal.append(files=[file])
+
+    def get_path(self, file_name):
+        return os.path.join(self._working_dir, file_name)
+
+    def get_unprocessed(self):
+        return [
+            file for file in self.dir_content.values() if not file.processed
+        ]
 
 
 class ReplayDirectoryWatchDog(DirectoryWatchDog):
@@ -87,13 +442,159 @@ class ReplayDirectoryWatchDog(DirectoryWatchDog):
 
 
 class DataBaseUpdater(object):
-    def __init__(self, watch_dog, db_path, db_framework='sqlite'):
-        self._db = DB(path=db_path, framework=db_framework)
+    def __init__(self,
+                 watch_dog,
+                 db_path,
+                 db_framework='sqlite',
+                 league=None,
+                 season=None,
+                 n_workers=None,
+                 cache_dir=None,
+                 protocol_builds=None,
+                 event_store_dir=None,
+                 event_store_format='npz',
+                 db_concurrent=False):
+        # parse workers don't need SQLAlchemy or NumPy
+        from src.db import DB
+        from src.events import STORE_FORMATS
+
+        # db_concurrent lets readers, e.g. scoring, run during ingestion
+        self._db = DB(path=db_path,
+                      framework=db_framework,
+                      concurrent=db_concurrent)
         self._watchdog = watch_dog
 
+        self.league = league
+        self.season = season
+
+        # None uses all cores, 0 parses in the calling process
+        self._n_workers = n_workers
+        self._cache_dir = cache_dir
+
+        # base builds of the expected replays, imported before workers start
+        self._protocol_builds = protocol_builds
+
+        # columnar tracker events per replay, e.g. next to the DB
+        self._event_store = None
+        if event_store_dir is not None:
+            if event_store_format not in STORE_FORMATS:
+                raise Exception(
+                    f'Unknown store format {event_store_format}. Choose one of {STORE_FORMATS}.'
+                )
+
+            os.makedirs(event_store_dir, exist_ok=True)
+            self._event_store = (event_store_dir, event_store_format)
+
+        # file name -> exception of replays that could not be ingested
+        self.failed_files = {}
+
         if not os.path.exists(db_path):
             self._db.create_db()
+        else:
+            self._db.migrate()
+
+    def __get_parse_jobs__(self):
+        files = [
+            file for file in self._watchdog.get_unprocessed()
+            if isinstance(file, ReplayFile)
+        ]
+
+        # copies of stored replays are never parsed, one query per batch
+        known = self._db.get_known_fingerprints(file.fingerprint
+                                                for file in files)
+
+        jobs = []
+        fingerprints = set()
+        for file in files:
+            if file.fingerprint in known:
+                self._watchdog.mark_processed(file.name)
+                self.failed_files.pop(file.name, None)
+                metrics.count('duplicates_skipped')
+                continue
+
+            # copies within the batch wait until the first one is stored
+            if file.fingerprint:
+                if file.fingerprint in fingerprints:
+                    continue
+                fingerprints.add(file.fingerprint)
+
+            jobs.append((file.name,
+                         (self._watchdog.get_path(file.name), self.league,
+                          self.season, file.match_id, file.round_id,
+                          file.fingerprint)))
+
+        return jobs
+
+    def __fail__(self, file_name, error):
+        self.failed_files[file_name] = error
+
+        metrics.begin_replay(file_name)
+        metrics.end_replay(error=error)
+
+    def __write_summary__(self, file_name, summary, record=None):
+        metrics.begin_replay(file_name, record=record)
+
+        try:
+            with metrics.timer('db_write'):
+                self._db.add_replay(summary)
+        except Exception as e:
+            self._db.session.rollback()
+            self.failed_files[file_name] = e
+            metrics.end_replay(error=e)
+            return
+
+        self._watchdog.mark_processed(file_name)
+
+        self.failed_files.pop(file_name, None)
+        metrics.end_replay()
+
+    def __update_serial__(self, jobs):
+        _init_parse_worker(self._cache_dir,
+                           protocol_builds=self._protocol_builds,
+                           event_store=self._event_store)
+
+        for file_name, args in jobs:
+            try:
+                summary, record = parse_replay_job(file_name, args)
+            except Exception as e:
+                self.__fail__(file_name, e)
+                continue
+
+            self.__write_summary__(file_name, summary, record)
+
+    def __update_parallel__(self, jobs):
+        warm_protocols(self._protocol_builds)
+
+        with ProcessPoolExecutor(max_workers=self._n_workers,
+                                 initializer=_init_parse_worker,
+                                 initargs=(self._cache_dir, metrics.enabled,
+                                           self._protocol_builds,
+                                           self._event_store)) as executor:
+            futures = {
+                executor.submit(parse_replay_job, file_name, args): file_name
+                for file_name, args in jobs
+            }
+
+            # this process is the only DB writer
+            for future in as_completed(futures):
+                file_name = futures[future]
+
+                try:
+                    summary, record = future.result()
+                except Exception as e:
+                    self.__fail__(file_name, e)
+                    continue
+
+                self.__write_summary__(file_name, summary, record)
 
     def update(self):
-        for file_name in self._watchdog.dir_content:
-            pass
+        self._watchdog.update()
+        jobs = self.__get_parse_jobs__()
+
+        if len(jobs) == 0:
+            return
+
+        if self._n_workers == 0 or len(jobs) == 1:
+            self.__update_serial__(jobs)
+        else:
+            self.__update_parallel__(jobs)
@@ -0,0 +1,55 @@
+import os
+from src.db import DB, Round
+from src.evaluation import Season
+from src.replay import Replay
+from src.synthetic import write_replays
+from src.workers import ReplayFile
+
+
+def get_summaries(directory, n_replays):
+    summaries = []
+
+    for path in write_replays(directory, n_replays, n_events=1000):
+        replay_file = ReplayFile(file_name=os.path.basename(path))
+        replay = Replay(path,
+                        league='Synthetic',
+                        season=1,
+                        match_id=replay_file.match_id,
+                        round_id=replay_file.round_id)
+        summaries.append(replay.get_slim_summary())
+
+    return summaries
+
+
+def test_result_cache_sees_other_writers(tmp_path):
+    db_path = str(tmp_path / 'db.db')
+    summaries = get_summaries(str(tmp_path / 'replays'), 6)
+
+    db = DB(path=db_path)
+    db.create_db()
+    db.add_replays(summaries[:3])
+
+    scores = Season('Synthetic', 1, db).get_scores()
+    assert len(db.result_cache) > 0
+
+    # another instance, e.g. the ingest service in another process
+    writer = DB(path=db_path)
+    writer.add_replays(summaries[3:])
+
+    new_scores = Season('Synthetic', 1, db).get_scores()
+    assert not new_scores.equals(scores)
+    assert new_scores.equals(
+        Season('Synthetic', 1, DB(path=db_path)).get_scores())
+
+
+def test_empty_fingerprints_are_not_duplicates(tmp_path):
+    summaries = get_summaries(str(tmp_path / 'replays'), 3)
+    for summary in summaries:
+        summary.fingerprint = ''
+
+    db = DB(path=str(tmp_path / 'db.db'))
+    db.create_db()
+    db.add_replays(summaries)
+
+    assert db.session.query(Round).count() == 3
+    assert db.get_known_fingerprints(['']) == set()
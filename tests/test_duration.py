@@ -0,0 +1,61 @@
+import pytest
+from src.replay import (DURATION_ENGINES, GATES_OPEN_EVENT, UNIT_DIED_EVENT,
+                        Replay)
+from src.synthetic import encode_replay, generate_decoded_replay
+
+N_EVENTS = 2000
+
+
+def write_replay(path, n_cores, n_core_deaths):
+    decoded_replay = generate_decoded_replay(seed=0,
+                                             n_events=N_EVENTS,
+                                             n_cores=n_cores,
+                                             n_core_deaths=n_core_deaths)
+
+    with open(path, 'wb') as f:
+        f.write(encode_replay(decoded_replay))
+
+    return decoded_replay['tracker_events']
+
+
+def get_expected_duration(tracker_events, core_tag=None):
+    start_gameloop = next(event['_gameloop'] for event in tracker_events
+                          if event.get('m_eventName') == GATES_OPEN_EVENT)
+    deaths = [
+        event for event in tracker_events if event['_event'] == UNIT_DIED_EVENT
+    ]
+
+    if core_tag is not None:
+        deaths = [
+            event for event in deaths if event['m_unitTagIndex'] == core_tag
+        ]
+
+    return int((deaths[-1]['_gameloop'] - start_gameloop) / 16)
+
+
+@pytest.mark.parametrize('n_cores, n_core_deaths, core_tag', [
+    (2, 1, 1),
+    (2, 0, None),
+    (0, 0, None),
+])
+def test_engines_agree(tmp_path, n_cores, n_core_deaths, core_tag):
+    path = str(tmp_path / 'replay.StormReplay')
+    tracker_events = write_replay(path, n_cores, n_core_deaths)
+
+    durations = {
+        engine: Replay(path, duration_engine=engine).duration
+        for engine in DURATION_ENGINES
+    }
+
+    assert durations['single_pass'] == durations['pandas']
+    assert durations['single_pass'] == get_expected_duration(
+        tracker_events, core_tag)
+
+
+@pytest.mark.parametrize('engine', DURATION_ENGINES)
+def test_two_cores_dying_raise(tmp_path, engine):
+    path = str(tmp_path / 'replay.StormReplay')
+    write_replay(path, n_cores=2, n_core_deaths=2)
+
+    with pytest.raises(Exception, match='Multiple cores died'):
+        Replay(path, duration_engine=engine)
@@ -0,0 +1,85 @@
+import os
+import random
+import pandas as pd
+from src.db import DB, PlayerScores
+from src.evaluation import Entity, Match, Season
+from src.replay import Replay
+from src.synthetic import (encode_replay, generate_decoded_replay,
+                           generate_details)
+
+ROUNDS_PER_MATCH = 5
+
+
+def add_replays(db, directory, n_matches, league=None, season=None):
+    # a small player pool, so players play several rounds of a match
+    os.makedirs(directory, exist_ok=True)
+    summaries = []
+
+    for i in range(n_matches * ROUNDS_PER_MATCH):
+        decoded_replay = generate_decoded_replay(seed=i, n_events=1000)
+        decoded_replay['details'] = generate_details(random.Random(i),
+                                                     player_pool=12)
+
+        path = os.path.join(directory, f'{i}.StormReplay')
+        with open(path, 'wb') as f:
+            f.write(encode_replay(decoded_replay))
+
+        replay = Replay(path,
+                        league=league,
+                        season=season,
+                        match_id=i // ROUNDS_PER_MATCH + 1,
+                        round_id=i % ROUNDS_PER_MATCH + 1)
+        summaries.append(replay.get_slim_summary())
+
+    db.add_replays(summaries)
+
+
+def get_expected_match_scores(match):
+    # the per-player nlargest(3) and mean the top-N path replaced
+    scores_df = Entity.get_scores(match, df=match.get_stats())
+
+    return pd.DataFrame({
+        player_id: group.nlargest(3, 'total').mean()
+        for player_id, group in scores_df.groupby('player_id')
+    }).T.drop(columns='player_id')
+
+
+def test_match_scores_with_null_keys(tmp_path):
+    db = DB(path=str(tmp_path / 'db.db'))
+    db.create_db()
+    add_replays(db, str(tmp_path / 'replays'), n_matches=2)
+
+    match = Match(None, None, 1, db)
+    scores = match.get_scores()
+    expected = get_expected_match_scores(match)
+
+    # players with more rounds than are counted
+    assert match.get_stats()['player_id'].value_counts().max() > 3
+    assert len(scores) == len(expected) > 0
+    pd.testing.assert_frame_equal(scores[expected.columns],
+                                  expected.loc[scores.index],
+                                  check_names=False,
+                                  check_dtype=False)
+
+
+def test_season_scores_with_null_keys(tmp_path):
+    db = DB(path=str(tmp_path / 'db.db'))
+    db.create_db()
+    add_replays(db, str(tmp_path / 'replays'), n_matches=2)
+
+    season = Season(None, None, db)
+    scores = season.get_scores()
+
+    # the same as scoring every match on its own
+    for match_in_season, match_id in season.match_ids.items():
+        match_scores = Match(None, None, match_in_season, db).get_scores()
+        season_scores = scores.xs(match_in_season, level='match')
+
+        assert (season_scores['match_id'] == match_id).all()
+        pd.testing.assert_frame_equal(season_scores[match_scores.columns],
+                                      match_scores,
+                                      check_like=True)
+
+    db.add_season_scores(season)
+
+    assert db.session.query(PlayerScores).count() == len(scores) > 0
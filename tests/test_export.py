@@ -0,0 +1,37 @@
+import os
+import pyarrow.dataset as ds
+from src.db import DB, PlayerScores, PlayerStats
+from src.evaluation import Season
+from src.export import export, load_state
+from src.replay import Replay
+from src.synthetic import write_replays
+from src.workers import ReplayFile
+
+
+def test_full_run_keeps_other_datasets(tmp_path):
+    db = DB(path=str(tmp_path / 'db.db'))
+    db.create_db()
+
+    summaries = []
+    for path in write_replays(str(tmp_path / 'replays'), 6, n_events=1000):
+        replay_file = ReplayFile(file_name=os.path.basename(path))
+        replay = Replay(path,
+                        league='Synthetic',
+                        season=1,
+                        match_id=replay_file.match_id,
+                        round_id=replay_file.round_id)
+        summaries.append(replay.get_slim_summary())
+    db.add_replays(summaries)
+    db.add_season_scores(Season('Synthetic', 1, db))
+
+    output_dir = str(tmp_path / 'export')
+    export(db, output_dir)
+    export(db, output_dir, datasets=['stats'])
+    export(db, output_dir, incremental=True)
+
+    # nothing was added, so nothing is exported twice
+    assert ds.dataset(os.path.join(output_dir, 'scores')).count_rows() == \
+        db.session.query(PlayerScores).count()
+    assert ds.dataset(os.path.join(output_dir, 'stats')).count_rows() == \
+        db.session.query(PlayerStats).count()
+    assert load_state(output_dir)['run'] == 2
@@ -0,0 +1,30 @@
+import pytest
+from src.replay import TIMELINE_METRICS, Replay
+from src.synthetic import encode_replay, generate_decoded_replay
+
+
+@pytest.mark.parametrize('score_interval, n_snapshots', [(0, 1), (500, 6)])
+def test_metrics_timeline(tmp_path, score_interval, n_snapshots):
+    path = str(tmp_path / 'replay.StormReplay')
+    decoded_replay = generate_decoded_replay(seed=0,
+                                             n_events=2500,
+                                             score_interval=score_interval)
+
+    with open(path, 'wb') as f:
+        f.write(encode_replay(decoded_replay))
+
+    replay = Replay(path)
+    timeline = replay.get_metrics_timeline()
+    n_players = len(decoded_replay['details']['m_playerList'])
+
+    assert len(timeline['blizzard_id']) == n_snapshots * n_players
+    assert len(set(timeline['gameloop'])) == n_snapshots
+
+    # the last snapshot is the final score
+    metrics = replay.get_metrics()
+    final = {
+        column: values[-n_players:]
+        for column, values in timeline.items()
+    }
+    for column in TIMELINE_METRICS.values():
+        assert final[column] == metrics[column].to_list()
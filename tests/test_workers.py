@@ -0,0 +1,48 @@
+from src.workers import File, FileStateJournal
+
+
+def get_file(name, fingerprint='abc', processed=True):
+    file = File(file_name=name)
+    file.size = 10
+    file.mtime = 20
+    file.fingerprint = fingerprint
+    if processed:
+        file.mark_processed()
+
+    return file
+
+
+def test_journal_round_trip(tmp_path):
+    path = str(tmp_path / 'files.csv')
+    journal = FileStateJournal(path=path)
+    journal.append(files=[get_file('a'), get_file('b', processed=False)])
+    journal.append(removed_files=[get_file('b')])
+
+    state = FileStateJournal(path=path).load()
+
+    assert list(state.keys()) == ['a']
+    assert state['a']['fingerprint'] == 'abc'
+    assert state['a']['processed']
+
+
+def test_journal_torn_line(tmp_path):
+    path = str(tmp_path / 'files.csv')
+    journal = FileStateJournal(path=path)
+    journal.append(files=[get_file('a'), get_file('b')])
+
+    # a crash while writing the last row
+    with open(path, 'rb') as f:
+        content = f.read()
+    with open(path, 'wb') as f:
+        f.write(content[:content.rindex(b'abc') + 2])
+
+    state = FileStateJournal(path=path).load()
+    assert list(state.keys()) == ['a']
+
+    # the next row is not appended to the torn line
+    FileStateJournal(path=path).append(files=[get_file('c')])
+
+    state = FileStateJournal(path=path).load()
+    assert sorted(state.keys()) == ['a', 'c']
+    assert state['c']['fingerprint'] == 'abc'
+    assert state['c']['processed']